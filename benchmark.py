@@ -0,0 +1,360 @@
+# /// script
+# requires-python = ">=3.12"
+# dependencies = [
+#     "numpy",
+#     "requests",
+#     "tqdm",
+# ]
+# ///
+
+"""
+Benchmarks build_static_feed.py offline, without a NAP API key or OSRM.
+
+Synthetic feeds with the structure of Renfe's are generated at the requested
+scales (1 is roughly the size of the "general" feed's stop_times.txt) and
+built with a local stub OSRM server. The time and peak memory of every stage
+of the build are reported.
+"""
+
+from argparse import ArgumentParser
+from contextlib import contextmanager
+import csv
+import io
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from typing import Iterator
+import zipfile
+
+import numpy as np
+
+import build_static_feed as builder
+
+
+# Rows of stop_times.txt at scale 1, about the size of the "general" feed
+BASE_STOP_TIMES = 100_000
+
+# The whole peninsula, of which Galicia is the north-western corner
+SPAIN_BOUNDS = {"SOUTH": 36.2, "NORTH": 43.7, "WEST": -9.3, "EAST": 3.2}
+GALICIA_BOUNDS = {"SOUTH": 42.1, "NORTH": 43.5, "WEST": -8.9, "EAST": -7.1}
+
+# Commuter lines with a constant headway, which carry one in REGULAR_SHARE trips
+REGULAR_LINES = 4
+REGULAR_SHARE = 4
+REGULAR_HEADWAY = 1800
+
+SERVICES = ["MD", "REGIONAL", "REG.EXP.", "AVANT", "AVE", "AVLO", "ALVIA", "INTERCITY"]
+
+
+def format_time(seconds: int) -> str:
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+def generate_feed(path: str, scale: float, seed: int = 42) -> int:
+    """
+    Writes a synthetic GTFS zip with the structure of Renfe's feeds.
+
+    Stations are scattered over Spain, with a denser cluster in Galicia. Lines
+    chain nearby stations, each line has a few stopping patterns (skipping
+    some intermediate stations) in both directions, and trips follow them at
+    random times through the day. One in REGULAR_SHARE trips runs instead on
+    a few commuter lines in Galicia, with fixed running times and a constant
+    headway, like Cercanías. Trip ids start with a 5-digit train number, like
+    Renfe's.
+
+    :param path: Where to write the zip
+    :param scale: Size of stop_times.txt relative to the "general" feed
+    :param seed: Seed of the random generator, so runs are comparable
+    :return: The number of stop_times rows written
+    :rtype: int
+    """
+
+    rng = random.Random(seed)
+    target_rows = int(BASE_STOP_TIMES * scale)
+
+    stations: list[tuple[str, str, float, float]] = []
+    for k in range(1500):
+        if k % 8 == 0:
+            lat = rng.uniform(GALICIA_BOUNDS["SOUTH"], GALICIA_BOUNDS["NORTH"])
+            lon = rng.uniform(GALICIA_BOUNDS["WEST"], GALICIA_BOUNDS["EAST"])
+        else:
+            lat = rng.uniform(SPAIN_BOUNDS["SOUTH"], SPAIN_BOUNDS["NORTH"])
+            lon = rng.uniform(SPAIN_BOUNDS["WEST"], SPAIN_BOUNDS["EAST"])
+        stations.append((f"{10000 + k:05d}", f"Estación de tren Estación {k}", round(lat, 6), round(lon, 6)))
+
+    coords = np.array([(lat, lon) for _, _, lat, lon in stations])
+    distances = np.hypot(coords[:, None, 0] - coords[None, :, 0], coords[:, None, 1] - coords[None, :, 1])
+    nearest = np.argsort(distances, axis=1)[:, 1:8]
+
+    # Lines are walks through nearby stations, without repeating any
+    lines: list[list[int]] = []
+    for _ in range(300):
+        line = [rng.randrange(len(stations))]
+        for _ in range(rng.randint(6, 24)):
+            candidates = [int(s) for s in nearest[line[-1]] if int(s) not in line]
+            if not candidates:
+                break
+            line.append(rng.choice(candidates))
+        lines.append(line)
+
+    routes = []
+    patterns: list[tuple[str, list[int]]] = []
+    for k, line in enumerate(lines):
+        service = SERVICES[k % len(SERVICES)]
+        route_id = f"1071VR{k:04d}{service.replace('.', '')}"
+        routes.append((route_id, "1071", service, f"Línea {k}", "2"))
+        for variant in range(3):
+            # Skip-stop variants keep both ends of the line
+            stops = [s for i, s in enumerate(line) if i in (0, len(line) - 1) or variant == 0 or rng.random() > 0.3]
+            patterns.append((route_id, stops))
+            patterns.append((route_id, stops[::-1]))
+
+    # Commuter lines in Galicia, with fixed running times and a departure
+    # every REGULAR_HEADWAY seconds, which --frequencies can compact
+    regular_patterns: list[tuple[str, list[int], list[int]]] = []
+    for k, start in enumerate(range(0, 8 * REGULAR_LINES, 8)):
+        line = [start]
+        for _ in range(8):
+            candidates = [int(s) for s in nearest[line[-1]] if int(s) not in line]
+            if not candidates:
+                break
+            line.append(rng.choice(candidates))
+        route_id = f"1071VC{k:04d}"
+        routes.append((route_id, "1071", "C1", f"Cercanías {k + 1}", "2"))
+        run_times = [rng.randrange(180, 600, 60) for _ in line[1:]]
+        regular_patterns.append((route_id, line, run_times))
+        regular_patterns.append((route_id, line[::-1], run_times[::-1]))
+
+    trips = []
+    train_number = 10000
+    regular_trips = 0
+    rows_written = 0
+
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as feed_zip:
+        with feed_zip.open("stop_times.txt", "w") as raw:
+            with io.TextIOWrapper(raw, encoding="utf-8", newline="") as f:
+                writer = csv.writer(f)
+                writer.writerow(["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence", "pickup_type", "drop_off_type"])
+
+                while rows_written < target_rows:
+                    trip_id = f"{train_number:05d}2026-01-01{train_number // 100000}"
+                    # Each pattern departs every REGULAR_HEADWAY from 05:00 to 22:00, on every service
+                    departure_slot, pattern_index = divmod(regular_trips, len(regular_patterns))
+                    service_index, departure_slot = divmod(departure_slot, 17 * 3600 // REGULAR_HEADWAY)
+                    if train_number % REGULAR_SHARE == 0 and service_index < 4:
+                        regular_trips += 1
+                        route_id, stops, run_times = regular_patterns[pattern_index]
+                        service_id = f"S{service_index}"
+                        clock = 5 * 3600 + departure_slot * REGULAR_HEADWAY
+                    else:
+                        route_id, stops = patterns[train_number % len(patterns)]
+                        service_id = f"S{rng.randrange(4)}"
+                        clock = rng.randrange(5 * 3600, 22 * 3600, 300)
+                        run_times = [rng.randrange(240, 1200, 60) for _ in stops[1:]]
+                    train_number += 1
+                    trips.append((route_id, service_id, trip_id, "", "1"))
+
+                    for sequence, stop in enumerate(stops, start=1):
+                        departure = clock + (60 if 1 < sequence < len(stops) else 0)
+                        writer.writerow([trip_id, format_time(clock), format_time(departure), stations[stop][0], sequence, 0, 0])
+                        if sequence < len(stops):
+                            clock = departure + run_times[sequence - 1]
+                    rows_written += len(stops)
+
+        def write_table(filename: str, header: list[str], rows: list) -> None:
+            with feed_zip.open(filename, "w") as raw:
+                with io.TextIOWrapper(raw, encoding="utf-8", newline="") as f:
+                    writer = csv.writer(f)
+                    writer.writerow(header)
+                    writer.writerows(rows)
+
+        write_table("agency.txt", ["agency_id", "agency_name", "agency_url", "agency_timezone", "agency_lang"],
+                    [("1071", "Renfe Viajeros", "https://www.renfe.com", "Europe/Madrid", "es")])
+        write_table("calendar.txt", ["service_id", "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday", "start_date", "end_date"],
+                    [(f"S{k}", 1, 1, 1, 1, 1, int(k < 2), int(k < 1), "20260101", "20261231") for k in range(4)])
+        write_table("stops.txt", ["stop_id", "stop_name", "stop_lat", "stop_lon", "wheelchair_boarding"],
+                    [(stop_id, name, lat, lon, 1) for stop_id, name, lat, lon in stations])
+        write_table("routes.txt", ["route_id", "agency_id", "route_short_name", "route_long_name", "route_type"], routes)
+        write_table("trips.txt", ["route_id", "service_id", "trip_id", "trip_headsign", "wheelchair_accessible"], trips)
+
+    return rows_written
+
+
+class StubOSRMHandler(BaseHTTPRequestHandler):
+    """
+    Answers /route/v1/<profile>/<coordinates> like OSRM, with a route made of
+    ten points per leg along the straight line between the waypoints.
+    """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _send(self, status: int, body: bytes = b"") -> None:
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_HEAD(self) -> None:
+        self._send(200)
+
+    def do_GET(self) -> None:
+        path = self.path.split("?", 1)[0]
+        if not path.startswith("/route/v1/"):
+            self._send(404)
+            return
+
+        waypoints = [
+            tuple(float(value) for value in pair.split(","))
+            for pair in path.rsplit("/", 1)[1].split(";")
+        ]
+        geometry = []
+        for (lon_a, lat_a), (lon_b, lat_b) in zip(waypoints, waypoints[1:]):
+            for step in range(10):
+                geometry.append([lon_a + (lon_b - lon_a) * step / 10, lat_a + (lat_b - lat_a) * step / 10])
+        geometry.append(list(waypoints[-1]))
+
+        body = {"code": "Ok", "routes": [{"geometry": {"type": "LineString", "coordinates": geometry}}]}
+        self._send(200, json.dumps(body).encode("utf-8"))
+
+
+@contextmanager
+def stub_osrm_server(handler: type[BaseHTTPRequestHandler] = StubOSRMHandler) -> Iterator[str]:
+    """
+    Runs a StubOSRMHandler server, or one of a subclass, on a free local
+    port, yielding its base URL.
+    """
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def run_benchmark(
+    scale: float, shapes: bool, trace_memory: bool, routing_mode: str, frequencies: bool = False
+) -> dict:
+    """
+    Generates a feed at the given scale and builds it, timing every stage.
+
+    :return: The size of the generated feed, the stages and the total time
+    :rtype: dict
+    """
+
+    with tempfile.TemporaryDirectory(prefix="renfe_galicia_bench_") as workdir:
+        input_path = os.path.join(workdir, "input.zip")
+        output_path = os.path.join(workdir, "output.zip")
+
+        generated = time.perf_counter()
+        rows = generate_feed(input_path, scale)
+        generated = time.perf_counter() - generated
+        logging.info(f"Generated {rows} stop_times rows at scale {scale} in {generated:.1f} s.")
+
+        metrics = builder.BuildMetrics(trace_memory=trace_memory)
+
+        with stub_osrm_server() as osrm_url:
+            osrm = builder.OSRMClient(osrm_url) if shapes else None
+            options = builder.BuildOptions(
+                output_zip=output_path,
+                osrm=osrm,
+                routing_mode=routing_mode,
+                frequencies=frequencies,
+                show_progress=False,
+            )
+            started = time.perf_counter()
+            try:
+                builder.build_feed("general", input_path, options, metrics=metrics)
+            finally:
+                if osrm is not None:
+                    osrm.close()
+            total = time.perf_counter() - started
+
+        return {
+            "scale": scale,
+            "stop_times_rows": rows,
+            "output_bytes": os.path.getsize(output_path),
+            **metrics.to_dict(),
+            "total_seconds": total,
+        }
+
+
+def print_results(result: dict) -> None:
+    print(
+        f"\nScale {result['scale']}: {result['stop_times_rows']} stop_times rows, "
+        f"{(result['osrm'] or {}).get('requests', 0)} OSRM requests, output {result['output_bytes'] / 1024:.0f} KiB"
+    )
+    print(f"{'stage':<24}{'seconds':>10}{'rows read':>12}{'written':>10}{'rows/s':>12}{'RSS MiB':>10}{'peak MiB':>10}")
+    for name, stage in result["stages"].items():
+        rss = f"{stage['peak_rss'] / 1024 / 1024:.1f}" if stage.get("peak_rss") is not None else "-"
+        peak = f"{stage['peak_memory'] / 1024 / 1024:.1f}" if "peak_memory" in stage else "-"
+        rate = f"{stage['rows_per_second']:.0f}" if stage["rows_per_second"] else "-"
+        print(
+            f"{name:<24}{stage['seconds']:>10.3f}{stage['rows_read']:>12}{stage['rows_written']:>10}"
+            f"{rate:>12}{rss:>10}{peak:>10}"
+        )
+    print(f"{'total':<24}{result['total_seconds']:>10.3f}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Benchmark the Renfe Galicia GTFS builder on synthetic feeds."
+    )
+    parser.add_argument(
+        "--scale",
+        type=float,
+        action="append",
+        help="Size of the synthetic stop_times.txt relative to the general feed. Can be repeated (default: 1)",
+    )
+    parser.add_argument(
+        "--no-shapes",
+        help="Skip shape generation",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--routing-mode",
+        choices=["segment", "sequence"],
+        default="segment",
+    )
+    parser.add_argument(
+        "--frequencies",
+        help="Compact the trips of lines with a constant headway into frequencies.txt",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--no-memory",
+        help="Do not trace memory, tracemalloc slows every stage down",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--json",
+        type=str,
+        help="Also write the results to this JSON file",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    logging.getLogger().handlers[0].addFilter(builder.FeedLogFilter())
+
+    results = [
+        run_benchmark(scale, not args.no_shapes, not args.no_memory, args.routing_mode, args.frequencies)
+        for scale in args.scale or [1.0]
+    ]
+    for result in results:
+        print_results(result)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
@@ -1,26 +1,61 @@
 # /// script
 # requires-python = ">=3.12"
 # dependencies = [
+#     "numpy",
 #     "requests",
 #     "tqdm",
 # ]
 # ///
 
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError, Namespace
+from array import array
+from collections.abc import Collection, Iterable, Iterator, Sequence
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar
+import cProfile
 import csv
+import gzip
+from dataclasses import dataclass, field
+import email.utils
+import hashlib
+import heapq
+import importlib.util
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+from itertools import groupby, repeat
 import json
 import logging
+import multiprocessing
+from operator import itemgetter
 import os
 import shutil
+import socket
+import sqlite3
+import sys
 import tempfile
+import threading
+import time
+import tracemalloc
+from typing import IO, TYPE_CHECKING, TextIO
 import zipfile
 
-import requests
-from tqdm import tqdm
+import numpy as np
 
+if TYPE_CHECKING:
+    import requests
 
-# Approximate bounding box for Galicia
-BOUNDS = {"SOUTH": 41.820455, "NORTH": 43.937462, "WEST": -9.437256, "EAST": -6.767578}
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+
+# Boundary of Galicia, simplified to ~1 km along the borders with Portugal,
+# Asturias and Castilla y León and generous on the coast
+REGION_FILE = os.path.join(os.path.dirname(__file__), "galicia.geojson")
+
+STOP_OVERRIDES_FILE = os.path.join(os.path.dirname(__file__), "stop_overrides.json")
 
 FEEDS = {
     "general": "1098",
@@ -28,96 +63,705 @@ FEEDS = {
     "feve": "1131"
 }
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
 
-def is_in_bounds(lat: float, lon: float) -> bool:
-    return (
-        BOUNDS["SOUTH"] <= lat <= BOUNDS["NORTH"]
-        and BOUNDS["WEST"] <= lon <= BOUNDS["EAST"]
-    )
+# Most sorted runs of stop_times.txt merged at once by --low-memory
+MERGE_FAN_IN = 64
+
+COMPRESSION_METHODS = {
+    "deflated": zipfile.ZIP_DEFLATED,
+    "stored": zipfile.ZIP_STORED,
+    "bzip2": zipfile.ZIP_BZIP2,
+    "lzma": zipfile.ZIP_LZMA,
+}
+
+# Mean Earth radius in metres
+EARTH_RADIUS = 6371008.8
+
+
+class Region:
+    """
+    A geographic area bounded by polygons, with a grid index over its
+    bounding box for fast point-in-polygon tests.
+
+    Every cell of the grid is known to be fully inside the area, fully
+    outside or crossed by its boundary. Only points in boundary cells need
+    the exact even-odd test against the polygon edges.
+    """
+
+    OUTSIDE, INSIDE, BOUNDARY = 0, 1, 2
+
+    def __init__(self, rings: Iterable[Sequence[Sequence[float]]], grid_size: int = 64):
+        """
+        :param rings: The rings of the polygons as [lon, lat] points. Holes are
+            rings too: a point is inside if it is enclosed by an odd number of rings
+        :param grid_size: Number of cells of the index along each axis
+        """
+
+        edges = []
+        for ring in rings:
+            points = np.asarray(ring, dtype=np.float64)
+            edges.append(np.hstack([points, np.roll(points, -1, axis=0)]))
+        self.edges = np.vstack(edges)
+
+        self.west, self.south = self.edges[:, :2].min(axis=0)
+        self.east, self.north = self.edges[:, :2].max(axis=0)
+        self.grid_size = grid_size
+        self._cell_width = (self.east - self.west) / grid_size
+        self._cell_height = (self.north - self.south) / grid_size
+
+        # Cells overlapping the bounding box of an edge may be crossed by it
+        cells = np.zeros((grid_size, grid_size), dtype=np.int8)
+        crossed = np.zeros((grid_size, grid_size), dtype=bool)
+        columns = self._column(np.stack([self.edges[:, 0], self.edges[:, 2]]))
+        rows = self._row(np.stack([self.edges[:, 1], self.edges[:, 3]]))
+        for (first_column, last_column), (first_row, last_row) in zip(
+            np.sort(columns, axis=0).T, np.sort(rows, axis=0).T
+        ):
+            crossed[first_row:last_row + 1, first_column:last_column + 1] = True
+
+        # Every other cell is entirely on one side, like its centre
+        row_index, column_index = np.nonzero(~crossed)
+        centres_inside = self._crosses_odd(
+            self.west + (column_index + 0.5) * self._cell_width,
+            self.south + (row_index + 0.5) * self._cell_height,
+        )
+        cells[row_index, column_index] = np.where(centres_inside, self.INSIDE, self.OUTSIDE)
+        cells[crossed] = self.BOUNDARY
+        self.cells = cells
+
+    @classmethod
+    def from_geojson(cls, path: str) -> "Region":
+        """
+        Loads the Polygon and MultiPolygon geometries of a GeoJSON file,
+        either a FeatureCollection, a Feature or a bare geometry.
+        """
+
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        features = data["features"] if data["type"] == "FeatureCollection" else [data]
+        rings: list[list[list[float]]] = []
+        for feature in features:
+            geometry = feature.get("geometry", feature)
+            if geometry["type"] == "Polygon":
+                rings.extend(geometry["coordinates"])
+            elif geometry["type"] == "MultiPolygon":
+                for polygon in geometry["coordinates"]:
+                    rings.extend(polygon)
+
+        if not rings:
+            raise ValueError(f"No polygons found in {path}")
+        return cls(rings)
+
+    def _column(self, lons: np.ndarray) -> np.ndarray:
+        return np.clip(((lons - self.west) / self._cell_width).astype(np.int64), 0, self.grid_size - 1)
+
+    def _row(self, lats: np.ndarray) -> np.ndarray:
+        return np.clip(((lats - self.south) / self._cell_height).astype(np.int64), 0, self.grid_size - 1)
+
+    def _crosses_odd(self, lons: np.ndarray, lats: np.ndarray) -> np.ndarray:
+        """
+        The exact even-odd test: casts a ray east of each point and counts the
+        edges it crosses.
+        """
+
+        lon_a, lat_a, lon_b, lat_b = (column[None, :] for column in self.edges.T)
+        lons = lons[:, None]
+        lats = lats[:, None]
+
+        straddles = (lat_a > lats) != (lat_b > lats)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crossing_lons = lon_a + (lats - lat_a) * (lon_b - lon_a) / (lat_b - lat_a)
+        crossings = np.count_nonzero(straddles & (lons < crossing_lons), axis=1)
+        return crossings % 2 == 1
+
+    def contains(self, lons: np.ndarray, lats: np.ndarray) -> np.ndarray:
+        """
+        :param lons: The longitudes of the points
+        :param lats: The latitudes of the points, in the same order
+        :return: Whether each point is inside the region
+        :rtype: np.ndarray
+        """
+
+        lons = np.asarray(lons, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+
+        inside = np.zeros(len(lons), dtype=bool)
+        in_box = (
+            (lons >= self.west) & (lons <= self.east)
+            & (lats >= self.south) & (lats <= self.north)
+        )
+        cells = np.full(len(lons), self.OUTSIDE, dtype=np.int8)
+        cells[in_box] = self.cells[self._row(lats[in_box]), self._column(lons[in_box])]
+
+        inside[cells == self.INSIDE] = True
+        boundary = cells == self.BOUNDARY
+        if boundary.any():
+            inside[boundary] = self._crosses_odd(lons[boundary], lats[boundary])
+        return inside
 
 
-def get_stops_in_bounds(stops_file: str):
-    with open(stops_file, "r", encoding="utf-8") as f:
-        stops = csv.DictReader(f)
+class StopLocations:
+    """
+    The coordinates of a set of stops, parsed once, and whether each of them
+    is inside the region being built.
+    """
+
+    def __init__(self, stop_ids: list[str], lons: np.ndarray, lats: np.ndarray, region: Region):
+        self.stop_ids = stop_ids
+        self.lons = lons
+        self.lats = lats
+        self.in_region = region.contains(lons, lats)
+
+        self._points = dict(zip(stop_ids, zip(lons.tolist(), lats.tolist())))
+        self._in_region = dict(zip(stop_ids, self.in_region.tolist()))
 
+    @classmethod
+    def from_rows(cls, stops: Iterable[dict], region: Region) -> "StopLocations":
+        stop_ids: list[str] = []
+        lons: list[float] = []
+        lats: list[float] = []
         for stop in stops:
-            lat = float(stop["stop_lat"])
-            lon = float(stop["stop_lon"])
-            if is_in_bounds(lat, lon):
-                yield stop
+            stop_ids.append(stop["stop_id"])
+            lons.append(float(stop["stop_lon"]))
+            lats.append(float(stop["stop_lat"]))
+
+        return cls(stop_ids, np.array(lons, dtype=np.float64), np.array(lats, dtype=np.float64), region)
+
+    def point(self, stop_id: str) -> tuple[float, float]:
+        """
+        :return: The (lon, lat) of the stop
+        :rtype: tuple[float, float]
+        """
+
+        return self._points[stop_id]
+
+    def is_in_region(self, stop_id: str) -> bool:
+        return self._in_region[stop_id]
 
+    def ids_in_region(self) -> list[str]:
+        return [stop_id for stop_id, inside in zip(self.stop_ids, self.in_region.tolist()) if inside]
 
-def get_trip_ids_for_stops(stoptimes_file: str, stop_ids: list[str]) -> list[str]:
-    trip_ids: set[str] = set()
 
-    with open(stoptimes_file, "r", encoding="utf-8") as f:
-        stop_times = csv.DictReader(f)
+@contextmanager
+def open_gtfs_table(gtfs_zip: zipfile.ZipFile, filename: str) -> Iterator[TextIO]:
+    """
+    Opens a table of a GTFS zip as a text stream, decompressing it on the fly.
+
+    :param gtfs_zip: The GTFS feed, opened for reading
+    :param filename: The member to read, e.g. "stops.txt"
+    :return: A text stream over the member, suitable for csv.DictReader
+    """
+
+    with gtfs_zip.open(filename, "r") as raw:
+        with io.TextIOWrapper(raw, encoding="utf-8", newline="") as f:
+            yield f
 
-        for stop_time in stop_times:
-            if stop_time["stop_id"] in stop_ids:
-                trip_ids.add(stop_time["trip_id"])
 
-    return list(trip_ids)
+def get_stop_locations(gtfs_zip: zipfile.ZipFile, region: Region) -> StopLocations:
+    with open_gtfs_table(gtfs_zip, "stops.txt") as f:
+        locations = StopLocations.from_rows(csv.DictReader(f), region)
 
+    record_rows(read=len(locations.stop_ids))
+    return locations
 
-def get_routes_for_trips(trips_file: str, trip_ids: list[str]) -> list[str]:
+
+def get_routes_for_trips(gtfs_zip: zipfile.ZipFile, trip_ids: Collection[str]) -> list[str]:
     route_ids: set[str] = set()
 
-    with open(trips_file, "r", encoding="utf-8") as f:
+    with open_gtfs_table(gtfs_zip, "trips.txt") as f:
         trips = csv.DictReader(f)
 
+        rows = 0
         for trip in trips:
+            rows += 1
             if trip["trip_id"] in trip_ids:
                 route_ids.add(trip["route_id"])
+        record_rows(read=rows)
 
     return list(route_ids)
 
 
-def get_distinct_stops_from_stop_times(
-    stoptimes_file: str, trip_ids: list[str]
-) -> list[str]:
-    stop_ids: set[str] = set()
+def parse_gtfs_time(value: str) -> int:
+    """
+    Converts a GTFS time (H:MM:SS, may be over 24:00:00) to seconds, or -1 if empty.
+    """
+
+    value = value.strip()
+    if not value:
+        return -1
+    hours, minutes, seconds = value.split(":")
+    return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
 
-    with open(stoptimes_file, "r", encoding="utf-8") as f:
-        stop_times = csv.DictReader(f)
+def format_gtfs_time(seconds: int) -> str:
+    if seconds < 0:
+        return ""
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
 
-        for stop_time in stop_times:
-            if stop_time["trip_id"] in trip_ids:
-                stop_ids.add(stop_time["stop_id"])
 
-    return list(stop_ids)
+class StopTimesStore:
+    """
+    Compact columnar copy of stop_times.txt, built from a single read of the file.
+
+    trip_id and stop_id are interned into integer codes and every column is a
+    NumPy array: sequences and times (in seconds, -1 if empty) as integers,
+    any other column as codes into its table of distinct values. Rows are
+    grouped by trip, in the order trips first appear in the file, and sorted
+    by stop_sequence within each trip. The rows of the trip with code `t` are
+    `offsets[t]:offsets[t + 1]`.
+    """
 
+    def __init__(
+        self,
+        fieldnames: list[str],
+        trip_ids: list[str],
+        stop_ids: list[str],
+        trip: np.ndarray,
+        stop: np.ndarray,
+        sequence: np.ndarray,
+        arrival: np.ndarray,
+        departure: np.ndarray,
+        extra: dict[str, tuple[list[str], np.ndarray]],
+    ):
+        self.fieldnames = fieldnames
+        self.trip_ids = trip_ids
+        self.stop_ids = stop_ids
+        self._trip_codes = {trip_id: code for code, trip_id in enumerate(trip_ids)}
+        self._stop_codes = {stop_id: code for code, stop_id in enumerate(stop_ids)}
+
+        order = np.lexsort((sequence, trip))
+        self.trip = trip[order]
+        self.stop = stop[order]
+        self.sequence = sequence[order]
+        self.arrival = arrival[order]
+        self.departure = departure[order]
+        self.extra = {name: (values, codes[order]) for name, (values, codes) in extra.items()}
+
+        self.offsets = np.zeros(len(trip_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(self.trip, minlength=len(trip_ids)), out=self.offsets[1:])
+
+    def __len__(self) -> int:
+        return len(self.trip)
+
+    def _trip_mask(self, trip_ids: Iterable[str]) -> np.ndarray:
+        mask = np.zeros(len(self.trip_ids), dtype=bool)
+        codes = [self._trip_codes[trip_id] for trip_id in trip_ids if trip_id in self._trip_codes]
+        mask[codes] = True
+        return mask
+
+    def trip_stops(self, trip_id: str) -> list[str]:
+        """
+        The stop_ids visited by a trip, in stop_sequence order.
+        """
+
+        code = self._trip_codes[trip_id]
+        stops = self.stop[self.offsets[code]:self.offsets[code + 1]]
+        return [self.stop_ids[stop] for stop in stops.tolist()]
+
+    def trip_ids_for_stops(self, stop_ids: Iterable[str]) -> set[str]:
+        codes = [self._stop_codes[stop_id] for stop_id in stop_ids if stop_id in self._stop_codes]
+        trips = np.unique(self.trip[np.isin(self.stop, codes)])
+        return {self.trip_ids[trip] for trip in trips.tolist()}
+
+    def distinct_stops(self, trip_ids: Iterable[str]) -> set[str]:
+        stops = np.unique(self.stop[self._trip_mask(trip_ids)[self.trip]])
+        return {self.stop_ids[stop] for stop in stops.tolist()}
+
+    def last_stop_for_trips(self, trip_ids: Iterable[str]) -> dict[str, str]:
+        last_stops: dict[str, str] = {}
+        for trip_id in trip_ids:
+            code = self._trip_codes.get(trip_id)
+            if code is not None and self.offsets[code + 1] > self.offsets[code]:
+                last_stops[trip_id] = self.stop_ids[self.stop[self.offsets[code + 1] - 1]]
+        return last_stops
+
+    def trip_rows(self, trip_id: str) -> list[list[str]]:
+        """
+        The rows of a trip as text, with the columns in `fieldnames` order.
+        """
+
+        code = self._trip_codes[trip_id]
+        rows = slice(self.offsets[code], self.offsets[code + 1])
+
+        columns: list[list[str]] = []
+        for name in self.fieldnames:
+            if name == "trip_id":
+                columns.append([trip_id] * (rows.stop - rows.start))
+            elif name == "stop_id":
+                columns.append([self.stop_ids[stop] for stop in self.stop[rows].tolist()])
+            elif name == "stop_sequence":
+                columns.append([str(sequence) for sequence in self.sequence[rows].tolist()])
+            elif name == "arrival_time":
+                columns.append([format_gtfs_time(time) for time in self.arrival[rows].tolist()])
+            elif name == "departure_time":
+                columns.append([format_gtfs_time(time) for time in self.departure[rows].tolist()])
+            else:
+                values, codes = self.extra[name]
+                columns.append([values[value] for value in codes[rows].tolist()])
+
+        return [list(row) for row in zip(*columns)]
+
+    def iter_trip_rows(self, trip_ids: Collection[str]) -> Iterator[tuple[str, list[list[str]]]]:
+        """
+        The rows of each of the given trips, in `trip_ids` order.
+        """
+
+        for trip_id in self.trip_ids:
+            if trip_id in trip_ids:
+                yield trip_id, self.trip_rows(trip_id)
+
+    def trip_pattern(self, trip_id: str) -> tuple[int, bytes] | None:
+        """
+        The start time of a trip, and a key shared by the trips that visit the
+        same stops at the same times relative to their start, with every other
+        column identical.
+
+        :return: The first arrival in seconds and the key, or None if the trip
+            has no first arrival time
+        :rtype: tuple[int, bytes] | None
+        """
+
+        code = self._trip_codes[trip_id]
+        rows = slice(self.offsets[code], self.offsets[code + 1])
+        arrival = self.arrival[rows].astype(np.int64)
+        departure = self.departure[rows].astype(np.int64)
+        if len(arrival) == 0 or arrival[0] < 0:
+            return None
+
+        start = int(arrival[0])
+        columns = [
+            self.stop[rows],
+            self.sequence[rows],
+            np.where(arrival >= 0, arrival - start, -1),
+            np.where(departure >= 0, departure - start, -1),
+            *(codes[rows] for _, codes in self.extra.values()),
+        ]
+        return start, np.vstack(columns).astype(np.int64).tobytes()
+
+    def trip_patterns(self, trip_ids: Collection[str]) -> dict[str, tuple[int, bytes] | None]:
+        """
+        trip_pattern of each of the given trips.
+        """
+
+        return {trip_id: self.trip_pattern(trip_id) for trip_id in trip_ids}
+
+
+def build_stop_times_store(gtfs_zip: zipfile.ZipFile) -> StopTimesStore:
+    """
+    Reads stop_times.txt once into a columnar StopTimesStore.
 
-def get_last_stop_for_trips(
-    stoptimes_file: str, trip_ids: list[str]
-) -> dict[str, str]:
-    trip_last: dict[str, str] = {}
-    trip_last_seq: dict[str, int] = {}
+    :param gtfs_zip: The GTFS feed containing stop_times.txt
+    :return: The store that every later stage queries instead of rescanning the file
+    :rtype: StopTimesStore
+    """
 
-    with open(stoptimes_file, "r", encoding="utf-8") as f:
-        reader = csv.DictReader(f)
-        if reader.fieldnames is None:
+    trip_codes: dict[str, int] = {}
+    stop_codes: dict[str, int] = {}
+    trip, stop = array("i"), array("i")
+    sequence, arrival, departure = array("i"), array("i"), array("i")
+
+    with open_gtfs_table(gtfs_zip, "stop_times.txt") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
             raise Exception("Fuck you, screw you, fieldnames is None and you just get rekt")
-        reader.fieldnames = [name.strip() for name in reader.fieldnames]
+        fieldnames = [name.strip() for name in header]
+
+        trip_col = fieldnames.index("trip_id")
+        stop_col = fieldnames.index("stop_id")
+        sequence_col = fieldnames.index("stop_sequence")
+        arrival_col = fieldnames.index("arrival_time")
+        departure_col = fieldnames.index("departure_time")
+
+        extra_cols = [
+            (col, name)
+            for col, name in enumerate(fieldnames)
+            if name not in ("trip_id", "stop_id", "stop_sequence", "arrival_time", "departure_time")
+        ]
+        extra_values: dict[str, dict[str, int]] = {name: {} for _, name in extra_cols}
+        extra_codes: dict[str, array] = {name: array("i") for _, name in extra_cols}
+
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < len(fieldnames):
+                row += [""] * (len(fieldnames) - len(row))
+
+            trip.append(trip_codes.setdefault(row[trip_col], len(trip_codes)))
+            stop.append(stop_codes.setdefault(row[stop_col], len(stop_codes)))
+            sequence.append(int(row[sequence_col]))
+            arrival.append(parse_gtfs_time(row[arrival_col]))
+            departure.append(parse_gtfs_time(row[departure_col]))
+            for col, name in extra_cols:
+                values = extra_values[name]
+                extra_codes[name].append(values.setdefault(row[col], len(values)))
+    record_rows(read=len(trip))
+
+    def column(values: array) -> np.ndarray:
+        return np.frombuffer(values, dtype=np.int32) if len(values) else np.zeros(0, dtype=np.int32)
+
+    return StopTimesStore(
+        fieldnames,
+        list(trip_codes),
+        list(stop_codes),
+        column(trip),
+        column(stop),
+        column(sequence),
+        column(arrival),
+        column(departure),
+        {name: (list(extra_values[name]), column(extra_codes[name])) for _, name in extra_cols},
+    )
+
+
+class SortedStopTimes:
+    """
+    Disk-backed stop_times.txt, sorted by trip_id and stop_sequence into a
+    temporary file, for feeds too large to keep in memory.
+
+    Only the position of each trip's rows in the file is kept in memory, plus
+    the stops of the trips selected by trip_ids_for_stops, which is answered
+    in a single ordered pass over the file. The stops of any other trip, and
+    every query over many trips, are also answered by streaming the file in
+    order; only trip_rows and trip_pattern read the rows of a single trip.
+    It answers the same queries as StopTimesStore; trip_ids are in trip_id
+    order instead of file order.
+    """
+
+    def __init__(self, fieldnames: list[str], f: IO[bytes], trips: dict[str, tuple[int, int]]):
+        """
+        :param fieldnames: The columns of the rows in the file
+        :param f: The sorted rows as CSV, open for reading
+        :param trips: The start and end offsets in the file of each trip's rows
+        """
+
+        self.fieldnames = fieldnames
+        self.trip_ids = list(trips)
+        self._file = f
+        self._trips = trips
+        self._trip_col = fieldnames.index("trip_id")
+        self._stop_col = fieldnames.index("stop_id")
+        self._arrival_col = fieldnames.index("arrival_time")
+        self._departure_col = fieldnames.index("departure_time")
+        self._stops: dict[str, list[str]] = {}
+
+    def close(self) -> None:
+        self._file.close()
+
+    def _scan(self) -> Iterator[tuple[str, list[list[str]]]]:
+        """
+        Streams every trip with its rows, in file order.
+        """
+
+        self._file.seek(0)
+        text = io.TextIOWrapper(self._file, encoding="utf-8", newline="")
+        try:
+            for trip_id, rows in groupby(csv.reader(text), key=itemgetter(self._trip_col)):
+                yield trip_id, list(rows)
+        finally:
+            # Otherwise the wrapper would close the file when collected
+            text.detach()
+
+    def _load_stops(self, trip_ids: Iterable[str]) -> None:
+        """
+        Keeps the stops of the given trips in memory, reading those that are
+        not yet in a single pass.
+        """
+
+        missing = {trip_id for trip_id in trip_ids if trip_id in self._trips} - self._stops.keys()
+        if missing:
+            for trip_id, rows in self._scan():
+                if trip_id in missing:
+                    self._stops[trip_id] = [row[self._stop_col] for row in rows]
+
+    def trip_rows(self, trip_id: str) -> list[list[str]]:
+        """
+        The rows of a trip as text, with the columns in `fieldnames` order.
+        """
+
+        start, end = self._trips[trip_id]
+        self._file.seek(start)
+        data = self._file.read(end - start).decode("utf-8")
+        return list(csv.reader(io.StringIO(data, newline="")))
+
+    def iter_trip_rows(self, trip_ids: Collection[str]) -> Iterator[tuple[str, list[list[str]]]]:
+        """
+        The rows of each of the given trips, streamed in file order.
+        """
+
+        for trip_id, rows in self._scan():
+            if trip_id in trip_ids:
+                yield trip_id, rows
+
+    def trip_stops(self, trip_id: str) -> list[str]:
+        self._load_stops([trip_id])
+        return self._stops[trip_id]
+
+    def trip_ids_for_stops(self, stop_ids: Iterable[str]) -> set[str]:
+        stop_ids = set(stop_ids)
+        selected: set[str] = set()
+        for trip_id, rows in self._scan():
+            stops = [row[self._stop_col] for row in rows]
+            if not stop_ids.isdisjoint(stops):
+                selected.add(trip_id)
+                self._stops[trip_id] = stops
+        return selected
+
+    def distinct_stops(self, trip_ids: Iterable[str]) -> set[str]:
+        trip_ids = list(trip_ids)
+        self._load_stops(trip_ids)
+        return {stop_id for trip_id in trip_ids for stop_id in self._stops.get(trip_id, ())}
+
+    def last_stop_for_trips(self, trip_ids: Iterable[str]) -> dict[str, str]:
+        trip_ids = list(trip_ids)
+        self._load_stops(trip_ids)
+        return {
+            trip_id: self._stops[trip_id][-1]
+            for trip_id in trip_ids
+            if self._stops.get(trip_id)
+        }
+
+    def _pattern(self, rows: list[list[str]]) -> tuple[int, bytes] | None:
+        if not rows or parse_gtfs_time(rows[0][self._arrival_col]) < 0:
+            return None
+
+        start = parse_gtfs_time(rows[0][self._arrival_col])
+        key_rows = []
+        for row in rows:
+            for col in (self._arrival_col, self._departure_col):
+                time = parse_gtfs_time(row[col])
+                row[col] = str(time - start if time >= 0 else -1)
+            row[self._trip_col] = ""
+            key_rows.append("\x1f".join(row))
+        return start, "\x1e".join(key_rows).encode("utf-8")
+
+    def trip_pattern(self, trip_id: str) -> tuple[int, bytes] | None:
+        """
+        The start time of a trip, and a key shared by the trips that visit the
+        same stops at the same times relative to their start, with every other
+        column identical. See StopTimesStore.trip_pattern.
+        """
+
+        return self._pattern(self.trip_rows(trip_id))
+
+    def trip_patterns(self, trip_ids: Collection[str]) -> dict[str, tuple[int, bytes] | None]:
+        """
+        trip_pattern of each of the given trips, in a single pass.
+        """
+
+        return {trip_id: self._pattern(rows) for trip_id, rows in self.iter_trip_rows(trip_ids)}
+
+
+def sort_stop_times(gtfs_zip: zipfile.ZipFile, memory_budget: int) -> SortedStopTimes:
+    """
+    Sorts stop_times.txt by trip_id and stop_sequence with an external merge
+    sort: runs that fit in `memory_budget` are sorted in memory and written
+    to temporary files, which are then merged into a single sorted file.
+
+    Rows are normalised like in StopTimesStore, so both give the same rows.
 
-        for stop_time in reader:
-            if stop_time["trip_id"] in trip_ids:
-                trip_id = stop_time["trip_id"]
-                if trip_last.get(trip_id, None) is None:
-                    trip_last[trip_id] = ""
-                    trip_last_seq[trip_id] = -1
+    :param gtfs_zip: The GTFS feed containing stop_times.txt
+    :param memory_budget: Approximate memory in bytes for the rows of a run
+    :return: The sorted stop times
+    :rtype: SortedStopTimes
+    """
+
+    runs: list[IO[str]] = []
+    rows_read = 0
+
+    def write_run(rows: list[list[str]]) -> None:
+        rows.sort(key=sort_key)
+        run = tempfile.TemporaryFile("w+", encoding="utf-8", newline="")
+        csv.writer(run).writerows(rows)
+        run.seek(0)
+        runs.append(run)
+        rows.clear()
+
+    with open_gtfs_table(gtfs_zip, "stop_times.txt") as f:
+        reader = csv.reader(f)
+        header = next(reader, None)
+        if header is None:
+            raise Exception("Fuck you, screw you, fieldnames is None and you just get rekt")
+        fieldnames = [name.strip() for name in header]
 
-                this_stop_seq = int(stop_time["stop_sequence"])
-                if this_stop_seq > trip_last_seq[trip_id]:
-                    trip_last_seq[trip_id] = this_stop_seq
-                    trip_last[trip_id] = stop_time["stop_id"]
+        trip_col = fieldnames.index("trip_id")
+        sequence_col = fieldnames.index("stop_sequence")
+        time_cols = (fieldnames.index("arrival_time"), fieldnames.index("departure_time"))
 
-    return trip_last
+        def sort_key(row: list[str]) -> tuple[str, int]:
+            return row[trip_col], int(row[sequence_col])
 
-def get_rows_by_ids(input_file: str, id_field: str, ids: list[str]) -> list[dict]:
+        # A row costs its strings plus the list holding them
+        row_overhead = 56 + 8 * len(fieldnames) + 49 * len(fieldnames)
+        run_rows: list[list[str]] = []
+        run_size = 0
+        for row in reader:
+            if not row:
+                continue
+            if len(row) < len(fieldnames):
+                row += [""] * (len(fieldnames) - len(row))
+
+            row[sequence_col] = str(int(row[sequence_col]))
+            for col in time_cols:
+                row[col] = format_gtfs_time(parse_gtfs_time(row[col]))
+
+            run_rows.append(row)
+            rows_read += 1
+            run_size += row_overhead + sum(map(len, row))
+            if run_size >= memory_budget:
+                write_run(run_rows)
+                run_size = 0
+        if run_rows:
+            write_run(run_rows)
+    record_rows(read=rows_read)
+    logging.debug(f"Sorted {rows_read} stop_times rows in {len(runs)} runs.")
+
+    # Merge runs in passes of at most MERGE_FAN_IN files, so that a small
+    # budget on a large feed does not run out of file descriptors
+    while len(runs) > MERGE_FAN_IN:
+        merged_runs: list[IO[str]] = []
+        for first in range(0, len(runs), MERGE_FAN_IN):
+            group = runs[first:first + MERGE_FAN_IN]
+            run = tempfile.TemporaryFile("w+", encoding="utf-8", newline="")
+            try:
+                csv.writer(run).writerows(heapq.merge(*(csv.reader(part) for part in group), key=sort_key))
+            finally:
+                for part in group:
+                    part.close()
+            run.seek(0)
+            merged_runs.append(run)
+        runs = merged_runs
+
+    sorted_file = tempfile.TemporaryFile("w+b")
+    trips: dict[str, tuple[int, int]] = {}
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    try:
+        merged = heapq.merge(*(csv.reader(run) for run in runs), key=sort_key)
+        for trip_id, rows in groupby(merged, key=itemgetter(trip_col)):
+            writer.writerows(rows)
+            data = buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+
+            start = sorted_file.tell()
+            sorted_file.write(data)
+            trips[trip_id] = (start, start + len(data))
+    finally:
+        for run in runs:
+            run.close()
+
+    return SortedStopTimes(fieldnames, sorted_file, trips)
+
+
+def get_rows_by_ids(
+    gtfs_zip: zipfile.ZipFile, filename: str, id_field: str, ids: Iterable[str]
+) -> list[dict]:
     rows: list[dict] = []
+    ids = set(ids)
 
-    with open(input_file, "r", encoding="utf-8") as f:
+    with open_gtfs_table(gtfs_zip, filename) as f:
         reader = csv.DictReader(f)
         if reader.fieldnames is None:
             raise Exception("Fuck you, screw you, fieldnames is None and you just get rekt")
@@ -126,412 +770,2644 @@ def get_rows_by_ids(input_file: str, id_field: str, ids: list[str]) -> list[dict
         for row in reader:
             if row[id_field].strip() in ids:
                 rows.append(row)
+        record_rows(read=reader.line_num - 1)
 
     return rows
 
-# First colour is background, second is text
-SERVICE_COLOURS = {
-    "REGIONAL": ("9A0060", "FFFFFF"),
-    "REG.EXP.": ("9A0060", "FFFFFF"),
 
-    "MD": ("F85B0B", "000000"),
-    "AVANT": ("F85B0B", "000000"),
+def compact_frequencies(
+    trips: list[dict], stop_times: StopTimesStore | SortedStopTimes, min_trips: int = 3
+) -> tuple[list[dict], list[dict]]:
+    """
+    Replaces runs of trips that run at a constant headway with frequencies.
+
+    Trips are grouped when every column of trips.txt but trip_id is the same
+    and they visit the same stops at the same times relative to their start.
+    Within a group, every run of at least `min_trips` trips starting at a
+    constant headway becomes a frequencies.txt entry with exact_times=1. All
+    the runs of a group use its first compacted trip as their template; the
+    rest of their trips are dropped. Trips outside any run are kept as they are.
+
+    :param trips: The rows of trips.txt to write
+    :param stop_times: The stop times of those trips
+    :param min_trips: The shortest run worth compacting
+    :return: The trips to write and the rows of frequencies.txt
+    :rtype: tuple[list[dict], list[dict]]
+    """
 
-    "AVLO": ("05CEC6", "000000"),
-    "AVE": ("FFFFFF", "9A0060"),
-    "ALVIA": ("FFFFFF", "9A0060"),
+    patterns = stop_times.trip_patterns({trip["trip_id"] for trip in trips})
+    groups: dict[tuple, list[tuple[int, dict]]] = {}
+    for trip in trips:
+        pattern = patterns.get(trip["trip_id"])
+        if pattern is None:
+            continue
+        start, pattern_key = pattern
+        attributes = tuple((name, value) for name, value in trip.items() if name != "trip_id")
+        groups.setdefault((attributes, pattern_key), []).append((start, trip))
+
+    dropped_trip_ids: set[str] = set()
+    frequencies: list[dict] = []
+    for group in groups.values():
+        group.sort(key=lambda item: item[0])
+        starts = [start for start, _ in group]
+        template_id: str | None = None
+        # Windows of the same template trip must not overlap
+        window_end = -1
+
+        i = 0
+        while i < len(group) - 1:
+            headway = starts[i + 1] - starts[i]
+            j = i + 1
+            while j + 1 < len(group) and starts[j + 1] - starts[j] == headway:
+                j += 1
+
+            if headway <= 0 or j - i + 1 < min_trips or starts[i] < window_end:
+                i += 1
+                continue
+
+            if template_id is None:
+                template_id = group[i][1]["trip_id"]
+            window_end = starts[j] + headway
+            frequencies.append({
+                "trip_id": template_id,
+                "start_time": format_gtfs_time(starts[i]),
+                "end_time": format_gtfs_time(window_end),
+                "headway_secs": headway,
+                "exact_times": 1,
+            })
+            dropped_trip_ids.update(
+                trip["trip_id"] for _, trip in group[i:j + 1] if trip["trip_id"] != template_id
+            )
+            i = j + 1
 
-    "INTERCITY": ("606060", "FFFFFF"),
+    return [trip for trip in trips if trip["trip_id"] not in dropped_trip_ids], frequencies
 
-    "TRENCELTA": ("00824A", "FFFFFF"),
 
-    # Cercanías Ferrol-Ortigueira
-    "C1": ("F5333F", "FFFFFF")
-}
+def shape_id_for_pattern(stop_ids: Sequence[str]) -> str:
+    """
+    Returns the shape_id of a stop pattern, the ordered stop_ids of a trip.
+
+    Every trip with the same pattern gets the same shape, and the id stays
+    the same from one build to the next.
+    """
 
+    digest = hashlib.sha1("\x1f".join(stop_ids).encode("utf-8")).hexdigest()
+    return f"Shape_{digest[:12]}"
 
-def colour_route(route_short_name: str) -> tuple[str, str]:
+
+# A sequence of (lon, lat) points, in the order OSRM expects them
+Coordinates = tuple[tuple[float, float], ...]
+
+
+def plan_shape_segments(
+    points: list[tuple[float, float]], in_region: Sequence[bool], pairwise: bool = False
+) -> list[tuple[Coordinates, bool]]:
     """
-    Returns the colours to be used for a route from its short name.
-    
-    :param route_short_name: The routes.txt's route_short_name
-    :return: A tuple containing the "route_color" (background) first and "route_text_color" (text) second
-    :rtype: tuple[str, str]
+    Splits the stops of a trip into the segments its shape is made of.
+
+    Runs of two or more consecutive stops in the region are routed with OSRM,
+    either as a single segment or, if `pairwise`, as one segment per pair of
+    consecutive stops. Any other pair of consecutive stops is a straight line.
+
+    :param points: The (lon, lat) of each stop of the trip, in order
+    :param in_region: Whether each stop is in the region
+    :param pairwise: Route each stop-to-stop pair on its own, so that trips
+        sharing stations share their routed segments
+    :return: The segments in order, each with whether it has to be routed
+    :rtype: list[tuple[Coordinates, bool]]
     """
 
-    route_name_searched = route_short_name.strip().upper()
-    
-    if route_name_searched in SERVICE_COLOURS:
-        return SERVICE_COLOURS[route_name_searched]
-    
-    print("Unknown route short name:", route_short_name)
-    return ("000000", "FFFFFF")
+    segments: list[tuple[Coordinates, bool]] = []
+    i = 0
+    while i < len(points) - 1:
+        if not in_region[i]:
+            # S_i is outside the region. Segment S_i -> S_{i+1} is straight line.
+            segments.append(((points[i], points[i + 1]), False))
+            i += 1
+            continue
 
+        # S_i is in the region. Find how many subsequent stops are also in it.
+        j = i + 1
+        while j < len(points) and in_region[j]:
+            j += 1
 
-if __name__ == "__main__":
-    parser = ArgumentParser(
-        description="Extract GTFS data for Galicia from Renfe GTFS feed."
-    )
-    parser.add_argument(
-        "nap_apikey",
-        type=str,
-        help="NAP API Key (https://nap.transportes.gob.es/)"
-    )
-    parser.add_argument(
-        "--osrm-url",
-        type=str,
-        help="OSRM server URL",
-        default="http://localhost:5050",
-        required=False,
-    )
-    parser.add_argument(
-        "--debug",
-        help="Enable debug logging",
-        action="store_true"
-    )
+        if j > i + 1:
+            # Stops from i to j-1 are in the region, route them.
+            if pairwise:
+                segments.extend(((points[k], points[k + 1]), True) for k in range(i, j - 1))
+            else:
+                segments.append((tuple(points[i:j]), True))
+            i = j - 1  # Next iteration starts from S_{j-1}
+        else:
+            # Only S_i is in the region, S_{i+1} is out.
+            # Segment S_i -> S_{i+1} is straight line.
+            segments.append(((points[i], points[i + 1]), False))
+            i += 1
 
-    args = parser.parse_args()
+    return segments
 
-    try:
-        osrm_check = requests.head(args.osrm_url, timeout=5)
-        GENERATE_SHAPES = osrm_check.status_code < 500
-    except requests.RequestException:
-        GENERATE_SHAPES = False
-        logging.warning("OSRM server is not reachable. Shape generation will be skipped.")
 
+def stitch_segments(segments: Iterable[Sequence[Sequence[float]]]) -> list[list[float]]:
+    """
+    Joins consecutive segment geometries into a single shape. Every segment
+    after the first starts where the previous one ended, so its first point
+    is dropped.
+    """
+
+    shape_points: list[list[float]] = []
+    for segment_points in segments:
+        if not shape_points:
+            shape_points.extend(list(point) for point in segment_points)
+        else:
+            shape_points.extend(list(point) for point in segment_points[1:])
+
+    return shape_points
 
-    logging.basicConfig(
-        level=logging.DEBUG if args.debug else logging.INFO,
-        format="%(asctime)s - %(levelname)s - %(message)s",
+
+def simplify_shape(points: np.ndarray, tolerance: float) -> np.ndarray:
+    """
+    Simplifies a polyline with the Douglas-Peucker algorithm.
+
+    :param points: The [lon, lat] points of the shape, as an (n, 2) array
+    :param tolerance: The maximum distance in metres between the original
+        line and the simplified one. 0 keeps every point
+    :return: The points that are kept, in order
+    :rtype: np.ndarray
+    """
+
+    if tolerance <= 0 or len(points) < 3:
+        return points
+
+    # Equirectangular projection to metres around the shape, precise enough
+    # to compare distances against a tolerance of a few metres
+    lat0 = np.radians(points[:, 1].mean())
+    xy = np.radians(points) * EARTH_RADIUS
+    xy[:, 0] *= np.cos(lat0)
+
+    keep = np.zeros(len(points), dtype=bool)
+    keep[0] = keep[-1] = True
+
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        start, end = xy[first], xy[last]
+        inner = xy[first + 1:last]
+        direction = end - start
+        length = np.hypot(direction[0], direction[1])
+        if length == 0:
+            distances = np.hypot(inner[:, 0] - start[0], inner[:, 1] - start[1])
+        else:
+            # Perpendicular distance of each inner point to the chord
+            distances = np.abs(
+                direction[0] * (inner[:, 1] - start[1]) - direction[1] * (inner[:, 0] - start[0])
+            ) / length
+
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+
+    return points[keep]
+
+
+def haversine_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """
+    Great-circle distances in metres between matching rows of two [lon, lat] arrays.
+    """
+
+    lon_a, lat_a = np.radians(a[:, 0]), np.radians(a[:, 1])
+    lon_b, lat_b = np.radians(b[:, 0]), np.radians(b[:, 1])
+    h = (
+        np.sin((lat_b - lat_a) / 2) ** 2
+        + np.cos(lat_a) * np.cos(lat_b) * np.sin((lon_b - lon_a) / 2) ** 2
     )
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(h))
 
-    for feed in FEEDS.keys():
-        INPUT_GTFS_FD, INPUT_GTFS_ZIP = tempfile.mkstemp(suffix=".zip", prefix=f"renfe_galicia_in_{feed}_")
-        INPUT_GTFS_PATH = tempfile.mkdtemp(prefix=f"renfe_galicia_in_{feed}_")
-        OUTPUT_GTFS_PATH = tempfile.mkdtemp(prefix=f"renfe_galicia_out_{feed}_")
-        OUTPUT_GTFS_ZIP = os.path.join(os.path.dirname(__file__), f"gtfs_renfe_galicia_{feed}.zip")
 
-        FEED_URL = f"https://nap.transportes.gob.es/api/Fichero/download/{FEEDS[feed]}"
+def cumulative_distances(points: np.ndarray) -> np.ndarray:
+    """
+    The shape_dist_traveled of every point of a shape, in metres from its start.
+    """
 
-        logging.info(f"Downloading GTFS feed '{feed}'...")
-        response = requests.get(FEED_URL, headers={"ApiKey": args.nap_apikey})
-        with open(INPUT_GTFS_ZIP, "wb") as f:
-            f.write(response.content)
+    distances = np.zeros(len(points))
+    if len(points) > 1:
+        np.cumsum(haversine_distances(points[:-1], points[1:]), out=distances[1:])
+    return distances
 
-        # Unzip the GTFS feed
-        with zipfile.ZipFile(INPUT_GTFS_ZIP, "r") as zip_ref:
-            zip_ref.extractall(INPUT_GTFS_PATH)
 
-        STOPS_FILE = os.path.join(INPUT_GTFS_PATH, "stops.txt")
-        STOP_TIMES_FILE = os.path.join(INPUT_GTFS_PATH, "stop_times.txt")
-        TRIPS_FILE = os.path.join(INPUT_GTFS_PATH, "trips.txt")
+def project_onto_shape(
+    points: np.ndarray, distances: np.ndarray, stop_points: np.ndarray
+) -> np.ndarray:
+    """
+    Finds how far along a shape each stop of its trip is.
 
-        all_stops_applicable = [stop for stop in get_stops_in_bounds(STOPS_FILE)]
-        logging.info(f"Total stops in Galicia: {len(all_stops_applicable)}")
+    Every stop is projected onto the closest segment of the shape that is not
+    before the previous stop, so distances never decrease along the trip.
 
-        stop_ids = [stop["stop_id"] for stop in all_stops_applicable]
-        trip_ids = get_trip_ids_for_stops(STOP_TIMES_FILE, stop_ids)
+    :param points: The [lon, lat] points of the shape
+    :param distances: The cumulative distance of each point, from cumulative_distances
+    :param stop_points: The [lon, lat] of each stop of the trip, in order
+    :return: The shape_dist_traveled of each stop, in metres
+    :rtype: np.ndarray
+    """
 
-        route_ids = get_routes_for_trips(TRIPS_FILE, trip_ids)
+    if len(points) < 2:
+        return np.zeros(len(stop_points))
 
-        logging.info(f"Feed parsed successfully. Stops: {len(stop_ids)}, trips: {len(trip_ids)}, routes: {len(route_ids)}")
-        if len(trip_ids) == 0 or len(route_ids) == 0:
-            logging.warning(f"No trips or routes found for feed '{feed}'. Skipping...")
-            shutil.rmtree(INPUT_GTFS_PATH)
-            shutil.rmtree(OUTPUT_GTFS_PATH)
-            continue
+    lat0 = np.radians(points[:, 1].mean())
+    scale = np.array([np.cos(lat0), 1.0])
+    xy = np.radians(points) * scale
+    stops_xy = np.radians(stop_points) * scale
 
-        # Copy agency.txt, calendar.txt, calendar_dates.txt as is
-        for filename in ["agency.txt", "calendar.txt", "calendar_dates.txt"]:
-            src_path = os.path.join(INPUT_GTFS_PATH, filename)
-            dest_path = os.path.join(OUTPUT_GTFS_PATH, filename)
-            if os.path.exists(src_path):
-                shutil.copy(src_path, dest_path)
-            else:
-                logging.debug(f"File {filename} does not exist in the input GTFS feed.")
+    starts, ends = xy[:-1], xy[1:]
+    directions = ends - starts
+    lengths_sq = np.einsum("ij,ij->i", directions, directions)
+    segment_lengths = np.diff(distances)
 
-        # Write new stops.txt with the stops in any trip that passes through Galicia
-        with open(
-            os.path.join(os.path.dirname(__file__), "stop_overrides.json"),
-            "r",
-            encoding="utf-8",
-        ) as f:
-            stop_overrides_raw: list = json.load(f)
-            stop_overrides = {
-                item["stop_id"]: item
-                for item in stop_overrides_raw
-            }
-            logging.debug(f"Loaded stop overrides for {len(stop_overrides)} stops.")
+    result = np.empty(len(stop_points))
+    first_segment = 0
+    for k, stop in enumerate(stops_xy):
+        offsets = stop - starts[first_segment:]
+        with np.errstate(divide="ignore", invalid="ignore"):
+            t = np.einsum("ij,ij->i", offsets, directions[first_segment:]) / lengths_sq[first_segment:]
+        t = np.clip(np.nan_to_num(t), 0.0, 1.0)
+        projected = starts[first_segment:] + t[:, None] * directions[first_segment:]
+        gaps = np.einsum("ij,ij->i", stop - projected, stop - projected)
 
-        distinct_stop_ids = get_distinct_stops_from_stop_times(
-            STOP_TIMES_FILE, trip_ids
+        closest = int(np.argmin(gaps))
+        segment = first_segment + closest
+        result[k] = distances[segment] + t[closest] * segment_lengths[segment]
+        first_segment = segment
+
+    return result
+
+
+class ShapesWriter:
+    """
+    Writes shapes.txt through a single open stream for the whole build.
+
+    Rows are buffered as tuples and written in batches. The stream can be a
+    regular file or a member of the output zip opened for writing.
+    """
+
+    FIELDNAMES = (
+        "shape_id",
+        "shape_pt_lat",
+        "shape_pt_lon",
+        "shape_pt_sequence",
+        "shape_dist_traveled",
+    )
+
+    def __init__(self, f: TextIO, batch_size: int = 10000):
+        self.f = f
+        self.batch_size = batch_size
+        self.rows_written = 0
+
+        self._writer = csv.writer(f)
+        self._writer.writerow(self.FIELDNAMES)
+        self._batch: list[tuple] = []
+
+    def write_shape(self, shape_id: str, points: np.ndarray, distances: np.ndarray) -> None:
+        """
+        :param shape_id: The shape_id of every row
+        :param points: The [lon, lat] points of the shape, in order
+        :param distances: The shape_dist_traveled of each point, in metres
+        """
+
+        # tolist() turns NumPy scalars into floats that csv writes plainly
+        lons = points[:, 0].tolist()
+        lats = points[:, 1].tolist()
+        self._batch.extend(
+            zip(
+                repeat(shape_id),
+                lats,
+                lons,
+                range(len(lats)),
+                np.round(distances, 1).tolist(),
+            )
         )
-        stops_in_trips = get_rows_by_ids(STOPS_FILE, "stop_id", distinct_stop_ids)
-        for stop in stops_in_trips:
-            stop["stop_code"] = stop["stop_id"]
-            if stop_overrides.get(stop["stop_id"], None) is not None:
-                override_item = stop_overrides[stop["stop_id"]]
+        if len(self._batch) >= self.batch_size:
+            self.flush()
 
-                if override_item.get("feed_id", None) is not None and override_item["feed_id"] != feed:
-                    continue
+    def flush(self) -> None:
+        self._writer.writerows(self._batch)
+        self.rows_written += len(self._batch)
+        record_rows(written=len(self._batch))
+        self._batch.clear()
 
-                for key, value in override_item.items():
-                    if key == "stop_id" or key == "feed_id":
-                        continue
-                    stop[key] = value
+    def close(self) -> None:
+        self.flush()
+        self.f.close()
 
-            if stop["stop_name"].startswith("Estación de tren "):
-                stop["stop_name"] = stop["stop_name"][17:].strip()
-                stop["stop_name"] = " ".join([
-                    word.capitalize() for word in stop["stop_name"].split(" ") if word != "de"
-                ])
+    def __enter__(self) -> "ShapesWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class GTFSZipWriter:
+    """
+    Writes the tables of a GTFS feed straight into the entries of a zip file.
+
+    The zip is written to a temporary file next to its destination, which is
+    only replaced once every table has been written. Anyone reading the
+    destination meanwhile sees either the previous feed or the new one, never
+    a half-written file. Used as a context manager, the output is discarded
+    if an exception is raised.
+    """
+
+    def __init__(
+        self, path: str, compression: int = zipfile.ZIP_DEFLATED, compresslevel: int | None = None
+    ):
+        self.path = path
+
+        fd, self._temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(path)),
+            prefix=f".{os.path.basename(path)}.",
+            suffix=".tmp",
+        )
+        os.close(fd)
+        self.zip = zipfile.ZipFile(
+            self._temp_path, "w", compression=compression, compresslevel=compresslevel
+        )
+
+    @contextmanager
+    def open_table(self, filename: str) -> Iterator[TextIO]:
+        """
+        Opens a new entry of the zip as a text stream. Only one entry can be
+        open at a time.
+        """
 
-        with open(
-            os.path.join(OUTPUT_GTFS_PATH, "stops.txt"),
-            "w",
-            encoding="utf-8",
-            newline="",
-        ) as f:
-            writer = csv.DictWriter(f, fieldnames=stops_in_trips[0].keys())
+        with self.zip.open(filename, "w") as raw:
+            with io.TextIOWrapper(raw, encoding="utf-8", newline="") as f:
+                yield f
+
+    def write_table(self, filename: str, fieldnames: Iterable[str], rows: Collection[dict]) -> None:
+        with self.open_table(filename) as f:
+            writer = csv.DictWriter(f, fieldnames=list(fieldnames))
             writer.writeheader()
-            writer.writerows(stops_in_trips)
+            writer.writerows(rows)
+        record_rows(written=len(rows))
+
+    def copy_member(self, source: zipfile.ZipFile, filename: str) -> None:
+        """
+        Copies a member of another zip as is, compressed with this zip's method.
+        """
+
+        with source.open(filename) as src, self.zip.open(filename, "w") as dest:
+            shutil.copyfileobj(src, dest, DOWNLOAD_CHUNK_SIZE)
+
+    def commit(self) -> None:
+        self.zip.close()
+        os.chmod(self._temp_path, 0o644)
+        os.replace(self._temp_path, self.path)
+
+    def abort(self) -> None:
+        self.zip.close()
+        os.remove(self._temp_path)
+
+    def __enter__(self) -> "GTFSZipWriter":
+        return self
 
-        # Write new routes.txt with the routes that have trips in Galicia
-        routes_in_trips = get_rows_by_ids(
-            os.path.join(INPUT_GTFS_PATH, "routes.txt"), "route_id", route_ids
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+
+
+class RouteCache:
+    """
+    Persistent cache of OSRM route geometries in a single SQLite file.
+
+    Entries are keyed by the ordered coordinates of the request together with
+    the OSRM profile and data version, so a different dataset never reuses
+    stale geometries. Once the cache grows over `max_size` bytes, the least
+    recently used entries are evicted when it is closed.
+    """
+
+    def __init__(self, path: str, version: str, max_size: int):
+        self.path = path
+        self.version = version
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        # Keys of the hits whose last_used is updated on commit, so that
+        # lookups never hold the write lock of the shared file while routing
+        self._used: dict[str, float] = {}
+
+        # Feeds built in parallel processes share the same file
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            """
+            CREATE TABLE IF NOT EXISTS routes (
+                key TEXT PRIMARY KEY,
+                geometry BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                last_used REAL NOT NULL
+            )
+            """
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS routes_last_used ON routes (last_used)")
+        self._db.commit()
+
+    def _key(self, coordinates: Coordinates) -> str:
+        return hashlib.sha256(
+            json.dumps([self.version, coordinates]).encode("utf-8")
+        ).hexdigest()
+
+    def get(self, coordinates: Coordinates) -> list[list[float]] | None:
+        key = self._key(coordinates)
+        row = self._db.execute("SELECT geometry FROM routes WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._used[key] = time.time()
+        flat = array("d")
+        flat.frombytes(row[0])
+        return [[flat[k], flat[k + 1]] for k in range(0, len(flat), 2)]
+
+    def put(self, coordinates: Coordinates, geometry: list[list[float]]) -> None:
+        blob = array("d", (value for point in geometry for value in point[:2])).tobytes()
+        self._db.execute(
+            "INSERT OR REPLACE INTO routes (key, geometry, size, last_used) VALUES (?, ?, ?, ?)",
+            (self._key(coordinates), blob, len(blob), time.time()),
         )
 
-        if feed == "feve":
-            feve_c1_route_ids = ["46T0001C1", "46T0002C1"]
-            new_route_id = "FEVE_C1"
+    def commit(self) -> None:
+        if self._used:
+            self._db.executemany(
+                "UPDATE routes SET last_used = ? WHERE key = ?",
+                [(last_used, key) for key, last_used in self._used.items()],
+            )
+            self._used.clear()
+        self._db.commit()
+
+    def evict(self) -> None:
+        """
+        Deletes the least recently used entries until the cache fits in max_size.
+        """
+
+        self._db.execute(
+            """
+            DELETE FROM routes WHERE key IN (
+                SELECT key FROM (
+                    SELECT key, SUM(size) OVER (ORDER BY last_used DESC, key) AS running_size
+                    FROM routes
+                )
+                WHERE running_size > ?
+            )
+            """,
+            (self.max_size,),
+        )
+        self._db.commit()
 
-            # Find agency_id and a template route
-            template_route = routes_in_trips[0] if routes_in_trips else {}
-            agency_id = "1"
-            for r in routes_in_trips:
-                if r["route_id"].strip() in feve_c1_route_ids:
-                    agency_id = r.get("agency_id", "1")
-                    template_route = r
-                    break
+    def close(self) -> None:
+        self.commit()
+        self.evict()
+        self._db.close()
 
-            # Filter out old routes
-            routes_in_trips = [r for r in routes_in_trips if r["route_id"].strip() not in feve_c1_route_ids]
 
-            # Add new route
-            new_route = template_route.copy()
-            new_route.update({
-                "route_id": new_route_id,
-                "route_short_name": "C1",
-                "route_long_name": "Ferrol - Xuvia - San Sadurniño - Ortigueira",
-                "route_type": "2",
-            })
-            if "agency_id" in template_route:
-                new_route["agency_id"] = agency_id
+class OSRMClient:
+    """
+    Routes stop sequences through an OSRM server, several requests at a time.
 
-            routes_in_trips.append(new_route)
+    Every worker thread keeps its own keep-alive session. Connection errors
+    and 429/5xx responses are retried with exponential backoff.
 
-        for route in routes_in_trips:
-            route["route_color"], route["route_text_color"] = colour_route(
-                route["route_short_name"]
+    With a RouteCache, geometries already known are never requested again. In
+    offline mode only the cache is used and nothing is sent to the server.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        concurrency: int = 8,
+        retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 10,
+        profile: str = "driving",
+        cache: RouteCache | None = None,
+        offline: bool = False,
+    ):
+        self.route_url = f"{base_url.rstrip('/')}/route/v1/{profile}/"
+        self.cache = cache
+        self.offline = offline
+        self.concurrency = max(1, concurrency)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        self.requests = 0
+        self.failures = 0
+        self.latencies: list[float] = []
+
+        self._local = threading.local()
+        self._sessions: list["requests.Session"] = []
+        self._sessions_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+
+    def _session(self) -> "requests.Session":
+        session = getattr(self._local, "session", None)
+        if session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(
+                total=self.retries,
+                backoff_factor=self.backoff,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=("GET",),
+                raise_on_status=False,
+            )
+            session = requests.Session()
+            session.mount("http://", HTTPAdapter(max_retries=retry))
+            session.mount("https://", HTTPAdapter(max_retries=retry))
+            self._local.session = session
+            with self._sessions_lock:
+                self._sessions.append(session)
+
+        return session
+
+    def route(self, coordinates: Coordinates) -> list[list[float]] | None:
+        """
+        Routes through the given points, in order.
+
+        :param coordinates: The (lon, lat) points to route through
+        :return: The route geometry as [lon, lat] points, or None if OSRM failed
+        :rtype: list[list[float]] | None
+        """
+
+        coords_str = ";".join(f"{lon},{lat}" for lon, lat in coordinates)
+        url = f"{self.route_url}{coords_str}?overview=full&geometries=geojson"
+
+        import requests
+
+        started = time.perf_counter()
+        data = None
+        try:
+            response = self._session().get(url, timeout=self.timeout)
+            if response.status_code == 200:
+                data = response.json()
+        except (requests.RequestException, ValueError):
+            pass
+
+        # Latency includes the retries of a request
+        with self._stats_lock:
+            self.requests += 1
+            self.latencies.append(time.perf_counter() - started)
+            if data is None or data.get("code") != "Ok":
+                self.failures += 1
+
+        if data is None or data.get("code") != "Ok":
+            return None
+        return data["routes"][0]["geometry"]["coordinates"]
+
+    def route_many(
+        self,
+        coordinate_lists: Iterable[Coordinates],
+        desc: str = "Routing",
+        show_progress: bool = True,
+    ) -> dict[Coordinates, list[list[float]] | None]:
+        """
+        Routes every distinct coordinate sequence, up to `concurrency` at a time.
+
+        :param coordinate_lists: The point sequences to route; duplicates are routed once
+        :return: The geometry of each sequence (None where OSRM failed)
+        :rtype: dict[Coordinates, list[list[float]] | None]
+        """
+
+        coordinate_lists = list(coordinate_lists)
+        results: dict[Coordinates, list[list[float]] | None] = {}
+        for coordinates in dict.fromkeys(coordinate_lists):
+            results[coordinates] = self.cache.get(coordinates) if self.cache else None
+        logging.debug(f"{len(results)} distinct routes for {len(coordinate_lists)} segments.")
+
+        missing = [coordinates for coordinates, geometry in results.items() if geometry is None]
+        if self.cache is not None:
+            logging.info(
+                f"Route cache: {len(results) - len(missing)} hits, {len(missing)} misses."
+            )
+        if self.offline:
+            if missing:
+                logging.warning(
+                    f"{len(missing)} routes are not cached and OSRM is offline, using straight lines."
+                )
+            if self.cache is not None:
+                self.cache.commit()
+            return results
+
+        from tqdm import tqdm
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            geometries = list(
+                tqdm(
+                    executor.map(self.route, missing),
+                    total=len(missing),
+                    desc=desc,
+                    disable=not show_progress,
+                )
             )
-        with open(
-            os.path.join(OUTPUT_GTFS_PATH, "routes.txt"),
-            "w",
-            encoding="utf-8",
-            newline="",
-        ) as f:
-            writer = csv.DictWriter(f, fieldnames=routes_in_trips[0].keys())
-            writer.writeheader()
-            writer.writerows(routes_in_trips)
-
-        # Write new trips.txt with the trips that pass through Galicia
-        last_stop_in_trips = get_last_stop_for_trips(STOP_TIMES_FILE, trip_ids)
-
-        trips_in_galicia = get_rows_by_ids(TRIPS_FILE, "trip_id", trip_ids)
-
-        if feed == "feve":
-            feve_c1_route_ids = ["46T0001C1", "46T0002C1"]
-            new_route_id = "FEVE_C1"
-            for tig in trips_in_galicia:
-                if tig["route_id"].strip() in feve_c1_route_ids:
-                    tig["route_id"] = new_route_id
-                    tig["direction_id"] = "1" if tig["route_id"].strip()[6] == "2" else "0"
-
-        stops_by_id = {stop["stop_id"]: stop for stop in stops_in_trips}
-
-        for tig in trips_in_galicia:
-            if GENERATE_SHAPES:
-                tig["shape_id"] = f"Shape_{tig['trip_id'][0:5]}"
-            tig["trip_headsign"] = stops_by_id[last_stop_in_trips[tig["trip_id"]]]["stop_name"]
-        with open(
-            os.path.join(OUTPUT_GTFS_PATH, "trips.txt"),
-            "w",
-            encoding="utf-8",
-            newline="",
-        ) as f:
-            writer = csv.DictWriter(f, fieldnames=trips_in_galicia[0].keys())
-            writer.writeheader()
-            writer.writerows(trips_in_galicia)
-
-        # Write new stop_times.txt with the stop times for any trip that passes through Galicia
-        stop_times_in_galicia = get_rows_by_ids(STOP_TIMES_FILE, "trip_id", trip_ids)
-        with open(
-            os.path.join(OUTPUT_GTFS_PATH, "stop_times.txt"),
-            "w",
-            encoding="utf-8",
-            newline="",
-        ) as f:
-            writer = csv.DictWriter(f, fieldnames=stop_times_in_galicia[0].keys())
-            writer.writeheader()
-            writer.writerows(stop_times_in_galicia)
 
-        logging.info("GTFS data for Galicia has been extracted successfully. Generate shapes for the trips...")
+        for coordinates, geometry in zip(missing, geometries):
+            results[coordinates] = geometry
+            if geometry and self.cache is not None:
+                self.cache.put(coordinates, geometry)
+        if self.cache is not None:
+            self.cache.commit()
+
+        return results
+
+    def counters(self) -> tuple[int, int, int, int, int]:
+        """
+        :return: The requests sent and failed, the latencies recorded and the
+            route cache hits and misses so far, to pass to stats() later
+        :rtype: tuple[int, int, int, int, int]
+        """
+
+        with self._stats_lock:
+            counters = (self.requests, self.failures, len(self.latencies))
+        if self.cache is None:
+            return (*counters, 0, 0)
+        return (*counters, self.cache.hits, self.cache.misses)
+
+    def stats(self, since: tuple[int, int, int, int, int] | None = None) -> dict:
+        """
+        :param since: counters() at the start of the period to report on, such
+            as a single build when the client is reused; everything since the
+            client was created if None
+        :return: The number of requests sent and failed, the route cache hits
+            and misses, and the 50th, 90th and 99th percentile and maximum
+            request latencies in milliseconds
+        :rtype: dict
+        """
+
+        requests, failures, latency_count, hits, misses = since or (0, 0, 0, 0, 0)
+        with self._stats_lock:
+            latencies = np.array(self.latencies[latency_count:]) * 1000
+            stats = {"requests": self.requests - requests, "failures": self.failures - failures}
+
+        if self.cache is not None:
+            hits = self.cache.hits - hits
+            misses = self.cache.misses - misses
+            lookups = hits + misses
+            stats["cache_hits"] = hits
+            stats["cache_misses"] = misses
+            stats["cache_hit_rate"] = round(hits / lookups, 4) if lookups else None
+
+        if len(latencies):
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99]).round(1).tolist()
+            stats["latency_ms"] = {"p50": p50, "p90": p90, "p99": p99, "max": round(float(latencies.max()), 1)}
+
+        return stats
+
+    def close(self) -> None:
+        with self._sessions_lock:
+            for session in self._sessions:
+                session.close()
+            self._sessions.clear()
+        if self.cache is not None:
+            self.cache.close()
+
+def short_hash(value: str) -> str:
+    return hashlib.blake2b(value.encode("utf-8"), digest_size=8).hexdigest()
+
+
+@dataclass
+class FeedSnapshot:
+    """
+    Compact fingerprint of a feed's input, saved after each build so that the
+    next one can tell what changed.
 
-        if GENERATE_SHAPES:
-            shape_ids_total = len(set(f"Shape_{trip_id[0:5]}" for trip_id in trip_ids))
-            shape_ids_generated: set[str] = set()
-
-            # Pre-load stops for quick lookup
-            stops_dict = {stop["stop_id"]: stop for stop in stops_in_trips}
-
-            # Group stop times by trip_id to avoid repeated file reads
-            stop_times_by_trip: dict[str, list[dict]] = {}
-            for st in stop_times_in_galicia:
-                tid = st["trip_id"]
-                if tid not in stop_times_by_trip:
-                    stop_times_by_trip[tid] = []
-                stop_times_by_trip[tid].append(st)
-
-            OSRM_BASE_URL = f"{args.osrm_url}/route/v1/driving/"
-            for trip_id in tqdm(trip_ids, total=shape_ids_total, desc="Generating shapes"):
-                shape_id = f"Shape_{trip_id[0:5]}"
-                if shape_id in shape_ids_generated:
-                    continue
+    :ivar stops: Hash of the coordinates of each stop
+    :ivar trips: Hash of the stop pattern and times of each selected trip
+    :ivar complete_shapes: The shapes that were fully routed by OSRM, without
+        straight-line fallbacks, and can be reused as they are
+    """
 
-                stop_seq = stop_times_by_trip.get(trip_id, [])
-                stop_seq.sort(key=lambda x: int(x["stop_sequence"].strip()))
+    stops: dict[str, str] = field(default_factory=dict)
+    trips: dict[str, str] = field(default_factory=dict)
+    complete_shapes: set[str] = field(default_factory=set)
+
+    @classmethod
+    def from_feed(
+        cls,
+        gtfs_zip: zipfile.ZipFile,
+        stop_times: StopTimesStore | SortedStopTimes,
+        trip_ids: Collection[str],
+    ) -> "FeedSnapshot":
+        snapshot = cls()
+
+        with open_gtfs_table(gtfs_zip, "stops.txt") as f:
+            for stop in csv.DictReader(f):
+                snapshot.stops[stop["stop_id"]] = short_hash(f"{stop['stop_lat']},{stop['stop_lon']}")
+        record_rows(read=len(snapshot.stops))
+
+        for trip_id, trip_rows in stop_times.iter_trip_rows(trip_ids):
+            snapshot.trips[trip_id] = short_hash(
+                "\x1f".join(",".join(row) for row in trip_rows)
+            )
 
-                if not stop_seq:
-                    continue
+        return snapshot
 
-                final_shape_points = []
-                i = 0
-                while i < len(stop_seq) - 1:
-                    stop_a = stops_dict[stop_seq[i]["stop_id"]]
-                    lat_a, lon_a = float(stop_a["stop_lat"]), float(stop_a["stop_lon"])
+    @classmethod
+    def load(cls, path: str) -> "FeedSnapshot | None":
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
 
-                    if not is_in_bounds(lat_a, lon_a):
-                        # S_i is out of bounds. Segment S_i -> S_{i+1} is straight line.
-                        stop_b = stops_dict[stop_seq[i+1]["stop_id"]]
-                        lat_b, lon_b = float(stop_b["stop_lat"]), float(stop_b["stop_lon"])
+        return cls(
+            stops=data["stops"],
+            trips=data["trips"],
+            complete_shapes=set(data["complete_shapes"]),
+        )
 
-                        segment_points = [[lon_a, lat_a], [lon_b, lat_b]]
-                        if not final_shape_points:
-                            final_shape_points.extend(segment_points)
-                        else:
-                            final_shape_points.extend(segment_points[1:])
-                        i += 1
-                    else:
-                        # S_i is in bounds. Find how many subsequent stops are also in bounds.
-                        j = i + 1
-                        while j < len(stop_seq):
-                            stop_j = stops_dict[stop_seq[j]["stop_id"]]
-                            if is_in_bounds(float(stop_j["stop_lat"]), float(stop_j["stop_lon"])):
-                                j += 1
-                            else:
-                                break
-
-                        # Stops from i to j-1 are in bounds.
-                        if j > i + 1:
-                            # We have at least two consecutive stops in bounds.
-                            in_bounds_stops = stop_seq[i:j]
-                            coordinates = []
-                            for st in in_bounds_stops:
-                                s = stops_dict[st["stop_id"]]
-                                coordinates.append(f"{s['stop_lon']},{s['stop_lat']}")
-
-                            coords_str = ";".join(coordinates)
-                            osrm_url = f"{OSRM_BASE_URL}{coords_str}?overview=full&geometries=geojson"
-
-                            segment_points = []
-                            try:
-                                response = requests.get(osrm_url, timeout=10)
-                                if response.status_code == 200:
-                                    data = response.json()
-                                    if data.get("code") == "Ok":
-                                        segment_points = data["routes"][0]["geometry"]["coordinates"]
-                            except Exception:
-                                pass
-
-                            if not segment_points:
-                                # Fallback to straight lines for this whole sub-sequence
-                                segment_points = []
-                                for k in range(i, j):
-                                    s = stops_dict[stop_seq[k]["stop_id"]]
-                                    segment_points.append([float(s["stop_lon"]), float(s["stop_lat"])])
-
-                            if not final_shape_points:
-                                final_shape_points.extend(segment_points)
-                            else:
-                                final_shape_points.extend(segment_points[1:])
-
-                            i = j - 1 # Next iteration starts from S_{j-1}
-                        else:
-                            # Only S_i is in bounds, S_{i+1} is out.
-                            # Segment S_i -> S_{i+1} is straight line.
-                            stop_b = stops_dict[stop_seq[i+1]["stop_id"]]
-                            lat_b, lon_b = float(stop_b["stop_lat"]), float(stop_b["stop_lon"])
-
-                            segment_points = [[lon_a, lat_a], [lon_b, lat_b]]
-                            if not final_shape_points:
-                                final_shape_points.extend(segment_points)
-                            else:
-                                final_shape_points.extend(segment_points[1:])
-                            i += 1
-
-                shape_ids_generated.add(shape_id)
-
-                with open(
-                    os.path.join(OUTPUT_GTFS_PATH, "shapes.txt"),
-                    "a",
-                    encoding="utf-8",
-                    newline="",
-                ) as f:
-                    fieldnames = [
-                        "shape_id",
-                        "shape_pt_lat",
-                        "shape_pt_lon",
-                        "shape_pt_sequence",
-                    ]
-                    writer = csv.DictWriter(f, fieldnames=fieldnames)
-
-                    if f.tell() == 0:
-                        writer.writeheader()
-
-                    for seq, point in enumerate(final_shape_points):
-                        writer.writerow(
-                            {
-                                "shape_id": shape_id,
-                                "shape_pt_lat": point[1],
-                                "shape_pt_lon": point[0],
-                                "shape_pt_sequence": seq,
-                            }
-                        )
-        else:
-            logging.info("Shape generation skipped as per user request.")
+    def save(self, path: str) -> None:
+        with gzip.open(path, "wt", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "stops": self.stops,
+                    "trips": self.trips,
+                    "complete_shapes": sorted(self.complete_shapes),
+                },
+                f,
+                separators=(",", ":"),
+            )
+
+
+def diff_hashes(previous: dict[str, str], current: dict[str, str]) -> tuple[set[str], set[str], set[str]]:
+    """
+    :return: The keys that were added, removed and changed between both
+    :rtype: tuple[set[str], set[str], set[str]]
+    """
 
-        # Create a ZIP archive of the output GTFS
-        with zipfile.ZipFile(OUTPUT_GTFS_ZIP, "w", zipfile.ZIP_DEFLATED) as zipf:
-            for root, _, files in os.walk(OUTPUT_GTFS_PATH):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    arcname = os.path.relpath(file_path, OUTPUT_GTFS_PATH)
-                    zipf.write(file_path, arcname)
+    added = current.keys() - previous.keys()
+    removed = previous.keys() - current.keys()
+    changed = {key for key in current.keys() & previous.keys() if current[key] != previous[key]}
+    return added, removed, changed
 
+
+def log_feed_changes(previous: FeedSnapshot, current: FeedSnapshot) -> None:
+    for name in ("trips", "stops"):
+        added, removed, changed = diff_hashes(getattr(previous, name), getattr(current, name))
         logging.info(
-            f"GTFS data from feed {feed} has been zipped successfully at {OUTPUT_GTFS_ZIP}."
+            f"Changes in {name} since the previous build: "
+            f"{len(added)} added, {len(removed)} removed, {len(changed)} changed."
         )
-        os.close(INPUT_GTFS_FD)
-        os.remove(INPUT_GTFS_ZIP)
-        shutil.rmtree(INPUT_GTFS_PATH)
-        shutil.rmtree(OUTPUT_GTFS_PATH)
+
+
+def read_shapes(gtfs_zip_path: str, shape_ids: Collection[str]) -> dict[str, tuple[np.ndarray, np.ndarray]]:
+    """
+    Reads some shapes back from a GTFS zip written by this script.
+
+    :param gtfs_zip_path: Path to the GTFS zip
+    :param shape_ids: The shapes to read
+    :return: The [lon, lat] points and shape_dist_traveled of each shape found
+    :rtype: dict[str, tuple[np.ndarray, np.ndarray]]
+    """
+
+    rows_by_shape: dict[str, list[tuple[int, float, float, float]]] = {}
+    if not shape_ids:
+        return {}
+
+    try:
+        with zipfile.ZipFile(gtfs_zip_path, "r") as gtfs_zip:
+            with open_gtfs_table(gtfs_zip, "shapes.txt") as f:
+                reader = csv.DictReader(f)
+                for row in reader:
+                    if row["shape_id"] in shape_ids:
+                        rows_by_shape.setdefault(row["shape_id"], []).append(
+                            (
+                                int(row["shape_pt_sequence"]),
+                                float(row["shape_pt_lon"]),
+                                float(row["shape_pt_lat"]),
+                                float(row["shape_dist_traveled"]),
+                            )
+                        )
+                record_rows(read=max(reader.line_num - 1, 0))
+    except (OSError, KeyError, zipfile.BadZipFile):
+        return {}
+
+    shapes: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+    for shape_id, rows in rows_by_shape.items():
+        rows.sort()
+        values = np.array(rows, dtype=np.float64)
+        shapes[shape_id] = (values[:, 1:3], values[:, 3])
+
+    return shapes
+
+
+# Column types of the exported tables; any other column is text. Times are
+# stored as seconds since midnight
+INTEGER_COLUMNS = {
+    "route_type", "direction_id", "wheelchair_accessible", "bikes_allowed",
+    "wheelchair_boarding", "location_type", "stop_sequence", "pickup_type",
+    "drop_off_type", "timepoint", "shape_pt_sequence", "headway_secs",
+    "exact_times", "exception_type", "monday", "tuesday", "wednesday",
+    "thursday", "friday", "saturday", "sunday",
+}
+REAL_COLUMNS = {"stop_lat", "stop_lon", "shape_pt_lat", "shape_pt_lon", "shape_dist_traveled"}
+TIME_COLUMNS = {"arrival_time", "departure_time", "start_time", "end_time"}
+
+# Indexes created in the SQLite export, on the tables that have their columns
+EXPORT_INDEXES = [("stop_id",), ("trip_id",), ("stop_id", "departure_time")]
+
+
+def column_type(name: str) -> str:
+    """
+    :return: The type of an exported column: "integer", "real" or "text"
+    :rtype: str
+    """
+
+    if name in INTEGER_COLUMNS or name in TIME_COLUMNS:
+        return "integer"
+    if name in REAL_COLUMNS:
+        return "real"
+    return "text"
+
+
+def read_typed_table(
+    gtfs_zip: zipfile.ZipFile, filename: str
+) -> tuple[list[str], Iterator[list[int | float | str | None]]]:
+    """
+    Reads a table of a GTFS zip with every value converted to the type of its
+    column. Empty values become None.
+
+    :return: The column names and an iterator over the converted rows, which
+        has to be consumed while the zip is open
+    :rtype: tuple[list[str], Iterator[list[int | float | str | None]]]
+    """
+
+    with open_gtfs_table(gtfs_zip, filename) as f:
+        header = next(csv.reader(f), None)
+    if header is None:
+        return [], iter(())
+    fieldnames = [name.strip() for name in header]
+
+    def convert(name: str):
+        if name in TIME_COLUMNS:
+            return lambda value: parse_gtfs_time(value) if value.strip() else None
+        if name in INTEGER_COLUMNS:
+            return lambda value: int(value) if value.strip() else None
+        if name in REAL_COLUMNS:
+            return lambda value: float(value) if value.strip() else None
+        return lambda value: value if value != "" else None
+
+    converters = [convert(name) for name in fieldnames]
+
+    def rows() -> Iterator[list[int | float | str | None]]:
+        with open_gtfs_table(gtfs_zip, filename) as f:
+            reader = csv.reader(f)
+            next(reader, None)
+            for row in reader:
+                if not row:
+                    continue
+                if len(row) < len(fieldnames):
+                    row += [""] * (len(fieldnames) - len(row))
+                yield [converter(value) for converter, value in zip(converters, row)]
+
+    return fieldnames, rows()
+
+
+def export_sqlite(gtfs_zip_path: str, dest_path: str) -> None:
+    """
+    Exports every table of a GTFS zip to a SQLite database with typed columns
+    and indexes on stop_id, trip_id and (stop_id, departure_time). The
+    database is written next to its destination and then moved into place.
+    """
+
+    fd, temp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(dest_path)),
+        prefix=f".{os.path.basename(dest_path)}.",
+        suffix=".tmp",
+    )
+    os.close(fd)
+    try:
+        with zipfile.ZipFile(gtfs_zip_path, "r") as gtfs_zip:
+            db = sqlite3.connect(temp_path)
+            try:
+                for filename in gtfs_zip.namelist():
+                    table = filename.removesuffix(".txt")
+                    fieldnames, rows = read_typed_table(gtfs_zip, filename)
+                    if not fieldnames:
+                        continue
+
+                    columns = ", ".join(f'"{name}" {column_type(name).upper()}' for name in fieldnames)
+                    db.execute(f'CREATE TABLE "{table}" ({columns})')
+                    placeholders = ", ".join("?" * len(fieldnames))
+                    db.executemany(f'INSERT INTO "{table}" VALUES ({placeholders})', rows)
+
+                    for index_columns in EXPORT_INDEXES:
+                        if all(name in fieldnames for name in index_columns):
+                            index_name = f"{table}_{'_'.join(index_columns)}"
+                            quoted = ", ".join(f'"{name}"' for name in index_columns)
+                            db.execute(f'CREATE INDEX "{index_name}" ON "{table}" ({quoted})')
+                db.commit()
+            finally:
+                db.close()
+
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, dest_path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+def export_parquet(gtfs_zip_path: str, dest_path: str) -> None:
+    """
+    Exports every table of a GTFS zip to a Parquet file with typed columns in
+    the directory dest_path, e.g. dest_path/stop_times.parquet. Requires
+    pyarrow, which is only imported when needed.
+    """
+
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError as e:
+        raise RuntimeError("The Parquet export requires pyarrow, install it with `pip install pyarrow`") from e
+
+    arrow_types = {"integer": pa.int64(), "real": pa.float64(), "text": pa.string()}
+
+    parent = os.path.dirname(os.path.abspath(dest_path))
+    temp_dir = tempfile.mkdtemp(dir=parent, prefix=f".{os.path.basename(dest_path)}.")
+    try:
+        with zipfile.ZipFile(gtfs_zip_path, "r") as gtfs_zip:
+            for filename in gtfs_zip.namelist():
+                fieldnames, rows = read_typed_table(gtfs_zip, filename)
+                if not fieldnames:
+                    continue
+
+                columns: list[list] = [[] for _ in fieldnames]
+                for row in rows:
+                    for column, value in zip(columns, row):
+                        column.append(value)
+                schema = pa.schema([(name, arrow_types[column_type(name)]) for name in fieldnames])
+                table = pa.Table.from_arrays(
+                    [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                    schema=schema,
+                )
+                pq.write_table(table, os.path.join(temp_dir, f"{filename.removesuffix('.txt')}.parquet"))
+
+        os.chmod(temp_dir, 0o755)
+        # A directory cannot be replaced atomically, so the old one is moved away first
+        if os.path.exists(dest_path):
+            old_dir = tempfile.mkdtemp(dir=parent, prefix=f".{os.path.basename(dest_path)}.old.")
+            os.replace(dest_path, os.path.join(old_dir, "export"))
+            os.replace(temp_dir, dest_path)
+            shutil.rmtree(old_dir)
+        else:
+            os.replace(temp_dir, dest_path)
+    except BaseException:
+        shutil.rmtree(temp_dir, ignore_errors=True)
+        raise
+
+
+EXPORTERS = {
+    "sqlite": export_sqlite,
+    "parquet": export_parquet,
+}
+
+
+def export_feed(gtfs_zip_path: str, formats: Iterable[str], force: bool = False) -> None:
+    """
+    Exports a built feed in each of the given formats, next to its zip with
+    the format as extension, e.g. gtfs_renfe_galicia_feve.sqlite.
+
+    :param gtfs_zip_path: The built GTFS zip
+    :param formats: Keys of EXPORTERS
+    :param force: Export again even if the export already exists, because
+        the zip has just been rebuilt
+    :raises Exception: The first error of the formats that failed, whose
+        exports are deleted after every other format has been exported
+    """
+
+    error: Exception | None = None
+    for export_format in formats:
+        dest_path = f"{gtfs_zip_path.removesuffix('.zip')}.{export_format}"
+        if force or not os.path.exists(dest_path):
+            try:
+                EXPORTERS[export_format](gtfs_zip_path, dest_path)
+            except Exception as e:
+                # An export of a previous zip would otherwise be kept, and
+                # never redone while the zip is unchanged
+                if os.path.isdir(dest_path):
+                    shutil.rmtree(dest_path)
+                elif os.path.exists(dest_path):
+                    os.remove(dest_path)
+                error = error or e
+                continue
+            logging.info(f"Exported {export_format} to {dest_path}.")
+
+    if error is not None:
+        raise error
+
+
+# First colour is background, second is text
+SERVICE_COLOURS = {
+    "REGIONAL": ("9A0060", "FFFFFF"),
+    "REG.EXP.": ("9A0060", "FFFFFF"),
+
+    "MD": ("F85B0B", "000000"),
+    "AVANT": ("F85B0B", "000000"),
+
+    "AVLO": ("05CEC6", "000000"),
+    "AVE": ("FFFFFF", "9A0060"),
+    "ALVIA": ("FFFFFF", "9A0060"),
+
+    "INTERCITY": ("606060", "FFFFFF"),
+
+    "TRENCELTA": ("00824A", "FFFFFF"),
+
+    # Cercanías Ferrol-Ortigueira
+    "C1": ("F5333F", "FFFFFF")
+}
+
+
+def colour_route(route_short_name: str) -> tuple[str, str]:
+    """
+    Returns the colours to be used for a route from its short name.
+    
+    :param route_short_name: The routes.txt's route_short_name
+    :return: A tuple containing the "route_color" (background) first and "route_text_color" (text) second
+    :rtype: tuple[str, str]
+    """
+
+    route_name_searched = route_short_name.strip().upper()
+    
+    if route_name_searched in SERVICE_COLOURS:
+        return SERVICE_COLOURS[route_name_searched]
+    
+    print("Unknown route short name:", route_short_name)
+    return ("000000", "FFFFFF")
+
+
+# Name of the feed being built, added to every log record
+current_feed: ContextVar[str] = ContextVar("current_feed", default="-")
+
+
+class FeedLogFilter(logging.Filter):
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.feed = current_feed.get()
+        return True
+
+
+def setup_logging(debug: bool) -> None:
+    """
+    Configures logging so that each record shows the feed it belongs to. Also
+    used as the initializer of worker processes.
+    """
+
+    logging.basicConfig(
+        level=logging.DEBUG if debug else logging.INFO,
+        format="%(asctime)s - %(levelname)s - [%(feed)s] %(message)s",
+    )
+    for handler in logging.getLogger().handlers:
+        if not any(isinstance(f, FeedLogFilter) for f in handler.filters):
+            handler.addFilter(FeedLogFilter())
+
+
+def feed_path(feed: str, suffix: str) -> str:
+    """
+    :return: The path of one of the files of a feed next to this script, as
+        gtfs_renfe_galicia_{feed}{suffix}
+    :rtype: str
+    """
+
+    return os.path.join(os.path.dirname(__file__), f"gtfs_renfe_galicia_{feed}{suffix}")
+
+
+def load_feed_state(state_file: str) -> dict:
+    """
+    Loads the download state saved after the last successful build of a feed.
+
+    :param state_file: Path to the feed's state JSON file
+    :return: The saved state, or an empty dict if there is none
+    :rtype: dict
+    """
+
+    try:
+        with open(state_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_feed_state(state_file: str, state: dict) -> None:
+    with open(state_file, "w", encoding="utf-8") as f:
+        json.dump(state, f, indent=2)
+
+
+def download_feed(
+    feed_url: str, apikey: str, dest_path: str, previous_state: dict
+) -> dict | None:
+    """
+    Streams a NAP feed to disk, asking the server to skip it if it is unchanged.
+
+    :param feed_url: The NAP download URL of the feed
+    :param apikey: The NAP API key
+    :param dest_path: Where to write the downloaded ZIP
+    :param previous_state: The state of the last build; its ETag and Last-Modified
+        are sent as conditional headers. Pass an empty dict to force a download.
+    :return: The new state ("etag", "last_modified" and the "sha256" of the
+        content), or None if the server answered 304 Not Modified
+    :rtype: dict | None
+    """
+
+    headers = {"ApiKey": apikey}
+    if previous_state.get("etag"):
+        headers["If-None-Match"] = previous_state["etag"]
+    if previous_state.get("last_modified"):
+        headers["If-Modified-Since"] = previous_state["last_modified"]
+
+    import requests
+
+    digest = hashlib.sha256()
+    with requests.get(feed_url, headers=headers, stream=True, timeout=60) as response:
+        if response.status_code == 304:
+            return None
+        response.raise_for_status()
+
+        with open(dest_path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+                digest.update(chunk)
+
+        return {
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "sha256": digest.hexdigest(),
+        }
+
+
+def read_peak_rss() -> int | None:
+    """
+    Returns the peak resident set size of this process in bytes, since it
+    started or since the last reset_peak_rss(), or None if it is unknown.
+    """
+
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    if resource is None:
+        return None
+    # ru_maxrss is in KiB on Linux but in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def reset_peak_rss() -> bool:
+    """
+    Resets the peak RSS to the current RSS, where the kernel allows it (Linux
+    with a writable /proc). Elsewhere the peak keeps growing for the whole
+    life of the process.
+
+    :return: Whether the peak was reset
+    :rtype: bool
+    """
+
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+class BuildMetrics:
+    """
+    Measures the stages of a build, which run one after the other: beginning
+    a stage ends the previous one.
+
+    Each stage records its wall time, the GTFS rows it read and wrote and the
+    peak RSS of the process while it ran, or None where the peak cannot be
+    reset between stages. With `trace_memory`, the peak memory
+    allocated by Python is also recorded using tracemalloc, which makes the
+    build noticeably slower. With a `profiler`, the stages in PROFILED_STAGES
+    run under cProfile.
+    """
+
+    PROFILED_STAGES = ("read_stop_times", "snapshot", "shapes", "stop_times")
+
+    def __init__(self, trace_memory: bool = False, profiler: cProfile.Profile | None = None):
+        self.trace_memory = trace_memory
+        self.profiler = profiler
+        self.stages: dict[str, dict[str, float]] = {}
+        self.osrm: dict | None = None
+        self._current: str | None = None
+        self._started = 0.0
+        self._peak_rss_reset = False
+
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def begin(self, name: str) -> None:
+        self.end()
+        self._current = name
+        self.stages.setdefault(
+            name, {"seconds": 0.0, "rows_read": 0, "rows_written": 0}
+        )
+        self._peak_rss_reset = reset_peak_rss()
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+        if self.profiler is not None and name in self.PROFILED_STAGES:
+            self.profiler.enable()
+        self._started = time.perf_counter()
+
+    def end(self) -> None:
+        if self._current is None:
+            return
+
+        elapsed = time.perf_counter() - self._started
+        if self.profiler is not None and self._current in self.PROFILED_STAGES:
+            self.profiler.disable()
+
+        stage = self.stages[self._current]
+        stage["seconds"] += elapsed
+        # Without a reset the peak would be the process's, not the stage's
+        peak_rss = read_peak_rss() if self._peak_rss_reset else None
+        if peak_rss is None:
+            stage["peak_rss"] = None
+        elif stage.get("peak_rss", 0) is not None:
+            stage["peak_rss"] = max(stage.get("peak_rss", 0), peak_rss)
+        if self.trace_memory:
+            stage["peak_memory"] = max(stage.get("peak_memory", 0), tracemalloc.get_traced_memory()[1])
+        self._current = None
+
+    def count(self, read: int = 0, written: int = 0) -> None:
+        """
+        Adds GTFS rows read or written to the current stage.
+        """
+
+        if self._current is None:
+            return
+        stage = self.stages[self._current]
+        stage["rows_read"] += read
+        stage["rows_written"] += written
+
+    def to_dict(self) -> dict:
+        """
+        :return: The stages, with their rows processed (read and written) per
+            second, the total time and the OSRM statistics, ready for JSON
+        :rtype: dict
+        """
+
+        stages = {}
+        for name, stage in self.stages.items():
+            rows = stage["rows_read"] + stage["rows_written"]
+            stages[name] = {
+                **stage,
+                "seconds": round(stage["seconds"], 4),
+                "rows_per_second": round(rows / stage["seconds"], 1) if stage["seconds"] > 0 else None,
+            }
+
+        return {
+            "total_seconds": round(sum(stage["seconds"] for stage in self.stages.values()), 4),
+            "stages": stages,
+            "osrm": self.osrm,
+        }
+
+
+# Metrics of the build running in this context, which the readers and writers
+# of GTFS tables report their rows to
+current_metrics: ContextVar[BuildMetrics | None] = ContextVar("current_metrics", default=None)
+
+
+def record_rows(read: int = 0, written: int = 0) -> None:
+    metrics = current_metrics.get()
+    if metrics is not None:
+        metrics.count(read, written)
+
+
+@dataclass
+class BuildOptions:
+    """
+    Everything besides the input feed that controls how a feed is built. The
+    same options, and so the same OSRM client and route cache, can be reused
+    to build several feeds.
+    """
+
+    # Path of the GTFS zip to write, gtfs_renfe_galicia_{feed}.zip next to
+    # this script if None. It is replaced atomically once the whole feed has
+    # been written
+    output_zip: str | None = None
+    # The client used to route shapes, or None to skip shape generation
+    osrm: OSRMClient | None = None
+    # The zipfile compression method and level (None for the method's
+    # default) of the output tables
+    compression: int = zipfile.ZIP_DEFLATED
+    compresslevel: int | None = None
+    # "segment" to route every distinct pair of consecutive stops once and
+    # stitch shapes from them, or "sequence" to route each run of stops in
+    # Galicia as a whole
+    routing_mode: str = "segment"
+    # Tolerance in metres used to simplify shapes, 0 writes every point
+    # returned by OSRM
+    shape_tolerance: float = 5.0
+    # Where to save the snapshot of this build's input, used by the next
+    # incremental build
+    snapshot_file: str | None = None
+    # The snapshot of the build that produced the current output_zip, built
+    # with the same options. If given, shapes whose stops are unchanged are
+    # copied from that output instead of routed again
+    previous_snapshot_file: str | None = None
+    show_progress: bool = True
+    # The area whose trips are kept, Galicia (REGION_FILE) by default
+    region: Region | None = None
+    stop_overrides_file: str = STOP_OVERRIDES_FILE
+    # Write trips that repeat at a constant headway as a single trip with
+    # frequencies.txt entries
+    frequencies: bool = False
+    # If set, stop_times.txt is sorted on disk using about this many bytes of
+    # memory instead of being loaded whole
+    low_memory: int | None = None
+
+
+@dataclass
+class FeedBuild:
+    """
+    A feed being built. Each stage of the pipeline reads what the previous
+    ones left here and adds its own results.
+    """
+
+    feed: str
+    input_zip: zipfile.ZipFile
+    options: BuildOptions
+    metrics: BuildMetrics = field(default_factory=BuildMetrics)
+
+    region: Region | None = None
+    stop_ids: list[str] = field(default_factory=list)
+    stop_times: StopTimesStore | SortedStopTimes | None = None
+    trip_ids: set[str] = field(default_factory=set)
+    route_ids: list[str] = field(default_factory=list)
+    snapshot: FeedSnapshot | None = None
+    previous_snapshot: FeedSnapshot | None = None
+    stops: list[dict] = field(default_factory=list)
+    routes: list[dict] = field(default_factory=list)
+    trips: list[dict] = field(default_factory=list)
+    # Trips with the same stop pattern share a single shape
+    shape_id_by_trip: dict[str, str] = field(default_factory=dict)
+    shape_patterns: dict[str, list[str]] = field(default_factory=dict)
+    # Distance along its shape of each stop of every pattern, in metres
+    stop_distances_by_shape: dict[str, list[float]] = field(default_factory=dict)
+    # The trips left in trips.txt, fewer than trip_ids if some were compacted
+    # into frequencies
+    written_trip_ids: set[str] = field(default_factory=set)
+    # Set by a stage to stop the build without writing anything
+    empty: bool = False
+    committed: bool = False
+
+    _output: GTFSZipWriter | None = field(default=None, repr=False)
+
+    @property
+    def output_zip(self) -> str:
+        return self.options.output_zip or feed_path(self.feed, ".zip")
+
+    @property
+    def output(self) -> GTFSZipWriter:
+        """
+        The writer of the output zip, created by the first stage that writes
+        a table.
+        """
+
+        if self._output is None:
+            self._output = GTFSZipWriter(
+                self.output_zip, self.options.compression, self.options.compresslevel
+            )
+        return self._output
+
+    def commit(self) -> None:
+        self.output.commit()
+        self.committed = True
+
+    def close(self) -> None:
+        """
+        Discards the output unless it was committed, and removes the sorted
+        stop times of a low-memory build.
+        """
+
+        if self._output is not None and not self.committed:
+            self._output.abort()
+        if isinstance(self.stop_times, SortedStopTimes):
+            self.stop_times.close()
+
+
+class Stage:
+    """
+    A step of a feed build. Its running time, rows and memory are recorded
+    as the metrics stage `name`.
+    """
+
+    name = ""
+
+    def enabled(self, build: FeedBuild) -> bool:
+        return True
+
+    def run(self, build: FeedBuild) -> None:
+        raise NotImplementedError
+
+
+class RegionFilterStage(Stage):
+    """
+    Finds the stops inside the region.
+    """
+
+    name = "bounds_filter"
+
+    def run(self, build: FeedBuild) -> None:
+        build.region = build.options.region or Region.from_geojson(REGION_FILE)
+        build.stop_ids = get_stop_locations(build.input_zip, build.region).ids_in_region()
+        logging.info(f"Total stops in Galicia: {len(build.stop_ids)}")
+
+
+class ReadStopTimesStage(Stage):
+    name = "read_stop_times"
+
+    def run(self, build: FeedBuild) -> None:
+        if build.options.low_memory is None:
+            build.stop_times = build_stop_times_store(build.input_zip)
+        else:
+            build.stop_times = sort_stop_times(build.input_zip, build.options.low_memory)
+
+
+class TripSelectionStage(Stage):
+    """
+    Selects the trips that stop in the region and their routes, and stops the
+    build if there are none.
+    """
+
+    name = "trip_route_selection"
+
+    def run(self, build: FeedBuild) -> None:
+        build.trip_ids = build.stop_times.trip_ids_for_stops(build.stop_ids)
+        build.written_trip_ids = build.trip_ids
+        build.route_ids = get_routes_for_trips(build.input_zip, build.trip_ids)
+
+        logging.info(
+            f"Feed parsed successfully. Stops: {len(build.stop_ids)}, "
+            f"trips: {len(build.trip_ids)}, routes: {len(build.route_ids)}"
+        )
+        if len(build.trip_ids) == 0 or len(build.route_ids) == 0:
+            logging.warning(f"No trips or routes found for feed '{build.feed}'. Skipping...")
+            build.empty = True
+
+
+class SnapshotStage(Stage):
+    """
+    Fingerprints the input for incremental builds, if the options save or
+    compare a snapshot.
+    """
+
+    name = "snapshot"
+
+    def enabled(self, build: FeedBuild) -> bool:
+        return (
+            build.options.snapshot_file is not None
+            or build.options.previous_snapshot_file is not None
+        )
+
+    def run(self, build: FeedBuild) -> None:
+        build.snapshot = FeedSnapshot.from_feed(build.input_zip, build.stop_times, build.trip_ids)
+        if build.options.previous_snapshot_file is not None:
+            build.previous_snapshot = FeedSnapshot.load(build.options.previous_snapshot_file)
+            if build.previous_snapshot is not None:
+                log_feed_changes(build.previous_snapshot, build.snapshot)
+
+
+class CopyTablesStage(Stage):
+    """
+    Copies agency.txt, calendar.txt and calendar_dates.txt as is.
+    """
+
+    name = "copy_tables"
+    tables = ("agency.txt", "calendar.txt", "calendar_dates.txt")
+
+    def run(self, build: FeedBuild) -> None:
+        input_members = set(build.input_zip.namelist())
+        for filename in self.tables:
+            if filename in input_members:
+                build.output.copy_member(build.input_zip, filename)
+            else:
+                logging.debug(f"File {filename} does not exist in the input GTFS feed.")
+
+
+class StopOverridesStage(Stage):
+    """
+    Writes stops.txt with the stops of the selected trips, fixing their names
+    and applying the overrides of stop_overrides.json.
+    """
+
+    name = "stop_overrides"
+
+    def run(self, build: FeedBuild) -> None:
+        with open(build.options.stop_overrides_file, "r", encoding="utf-8") as f:
+            stop_overrides_raw: list = json.load(f)
+            stop_overrides = {
+                item["stop_id"]: item
+                for item in stop_overrides_raw
+            }
+            logging.debug(f"Loaded stop overrides for {len(stop_overrides)} stops.")
+
+        distinct_stop_ids = build.stop_times.distinct_stops(build.trip_ids)
+        build.stops = get_rows_by_ids(build.input_zip, "stops.txt", "stop_id", distinct_stop_ids)
+        for stop in build.stops:
+            stop["stop_code"] = stop["stop_id"]
+            if stop_overrides.get(stop["stop_id"], None) is not None:
+                override_item = stop_overrides[stop["stop_id"]]
+
+                if override_item.get("feed_id", None) is not None and override_item["feed_id"] != build.feed:
+                    continue
+
+                for key, value in override_item.items():
+                    if key == "stop_id" or key == "feed_id":
+                        continue
+                    stop[key] = value
+
+            if stop["stop_name"].startswith("Estación de tren "):
+                stop["stop_name"] = stop["stop_name"][17:].strip()
+                stop["stop_name"] = " ".join([
+                    word.capitalize() for word in stop["stop_name"].split(" ") if word != "de"
+                ])
+
+        build.output.write_table("stops.txt", build.stops[0].keys(), build.stops)
+
+
+# FEVE splits the C1 line in one route per direction, which are merged into one
+FEVE_C1_ROUTE_IDS = ["46T0001C1", "46T0002C1"]
+FEVE_C1_NEW_ROUTE_ID = "FEVE_C1"
+
+
+class RoutesStage(Stage):
+    """
+    Writes routes.txt with the routes of the selected trips and their colours.
+    """
+
+    name = "routes"
+
+    def run(self, build: FeedBuild) -> None:
+        build.routes = get_rows_by_ids(build.input_zip, "routes.txt", "route_id", build.route_ids)
+
+        if build.feed == "feve":
+            # Find agency_id and a template route
+            template_route = build.routes[0] if build.routes else {}
+            agency_id = "1"
+            for r in build.routes:
+                if r["route_id"].strip() in FEVE_C1_ROUTE_IDS:
+                    agency_id = r.get("agency_id", "1")
+                    template_route = r
+                    break
+
+            # Filter out old routes
+            build.routes = [r for r in build.routes if r["route_id"].strip() not in FEVE_C1_ROUTE_IDS]
+
+            # Add new route
+            new_route = template_route.copy()
+            new_route.update({
+                "route_id": FEVE_C1_NEW_ROUTE_ID,
+                "route_short_name": "C1",
+                "route_long_name": "Ferrol - Xuvia - San Sadurniño - Ortigueira",
+                "route_type": "2",
+            })
+            if "agency_id" in template_route:
+                new_route["agency_id"] = agency_id
+
+            build.routes.append(new_route)
+
+        for route in build.routes:
+            route["route_color"], route["route_text_color"] = colour_route(
+                route["route_short_name"]
+            )
+        build.output.write_table("routes.txt", build.routes[0].keys(), build.routes)
+
+
+class HeadsignsStage(Stage):
+    """
+    Reads the selected trips, giving them the name of their last stop as
+    headsign and the shape of their stop pattern.
+    """
+
+    name = "headsigns"
+
+    def run(self, build: FeedBuild) -> None:
+        stop_times = build.stop_times
+        last_stop_in_trips = stop_times.last_stop_for_trips(build.trip_ids)
+
+        build.trips = get_rows_by_ids(build.input_zip, "trips.txt", "trip_id", build.trip_ids)
+
+        if build.feed == "feve":
+            for trip in build.trips:
+                if trip["route_id"].strip() in FEVE_C1_ROUTE_IDS:
+                    trip["route_id"] = FEVE_C1_NEW_ROUTE_ID
+                    trip["direction_id"] = "1" if trip["route_id"].strip()[6] == "2" else "0"
+
+        stops_by_id = {stop["stop_id"]: stop for stop in build.stops}
+
+        build.shape_id_by_trip = {
+            trip_id: shape_id_for_pattern(stop_times.trip_stops(trip_id))
+            for trip_id in build.trip_ids
+        }
+        # A single stop has no shape, so those trips are left without one
+        build.shape_patterns = {
+            build.shape_id_by_trip[trip_id]: stop_seq
+            for trip_id in sorted(build.trip_ids)
+            if len(stop_seq := stop_times.trip_stops(trip_id)) >= 2
+        }
+        logging.debug(f"{len(build.trip_ids)} trips follow {len(build.shape_patterns)} stop patterns.")
+
+        for trip in build.trips:
+            if build.options.osrm is not None:
+                shape_id = build.shape_id_by_trip[trip["trip_id"]]
+                trip["shape_id"] = shape_id if shape_id in build.shape_patterns else ""
+            trip["trip_headsign"] = stops_by_id[last_stop_in_trips[trip["trip_id"]]]["stop_name"]
+
+
+class FrequenciesStage(Stage):
+    """
+    Compacts trips that repeat at a constant headway and writes their
+    frequencies.txt, if enabled in the options.
+    """
+
+    name = "frequencies"
+
+    def enabled(self, build: FeedBuild) -> bool:
+        return build.options.frequencies
+
+    def run(self, build: FeedBuild) -> None:
+        if "frequencies.txt" in build.input_zip.namelist():
+            logging.warning("The feed already has frequencies.txt, trips will not be compacted.")
+            return
+
+        trip_count = len(build.trips)
+        build.trips, frequency_rows = compact_frequencies(build.trips, build.stop_times)
+        build.written_trip_ids = {trip["trip_id"] for trip in build.trips}
+        logging.info(
+            f"Compacted {trip_count - len(build.trips)} trips into "
+            f"{len(frequency_rows)} frequencies."
+        )
+        if frequency_rows:
+            build.output.write_table("frequencies.txt", frequency_rows[0].keys(), frequency_rows)
+
+
+class TripsStage(Stage):
+    name = "trips"
+
+    def run(self, build: FeedBuild) -> None:
+        build.output.write_table("trips.txt", build.trips[0].keys(), build.trips)
+        logging.info("GTFS data for Galicia has been extracted successfully. Generate shapes for the trips...")
+
+
+class ShapesStage(Stage):
+    """
+    Routes the shape of every stop pattern with OSRM and writes shapes.txt,
+    if the options have an OSRM client.
+    """
+
+    name = "shapes"
+
+    def run(self, build: FeedBuild) -> None:
+        osrm = build.options.osrm
+        if osrm is None:
+            logging.info("Shape generation skipped as per user request.")
+            return
+
+        # The client may be reused across builds, so only this one's
+        # requests are reported
+        osrm_counters = osrm.counters()
+        shape_patterns = build.shape_patterns
+        snapshot = build.snapshot
+        previous_snapshot = build.previous_snapshot
+
+        # Overrides may have moved some stops, so they are located again
+        stop_locations = StopLocations.from_rows(build.stops, build.region)
+
+        # Shapes whose stops have not moved since the previous build are
+        # carried over from its output instead of being routed again
+        reused_shapes: dict[str, tuple[np.ndarray, np.ndarray]] = {}
+        if previous_snapshot is not None and snapshot is not None:
+            reusable_shape_ids = {
+                shape_id
+                for shape_id, stop_seq in shape_patterns.items()
+                if shape_id in previous_snapshot.complete_shapes
+                and all(
+                    previous_snapshot.stops.get(stop_id) == snapshot.stops.get(stop_id)
+                    for stop_id in stop_seq
+                )
+            }
+            reused_shapes = read_shapes(build.output_zip, reusable_shape_ids)
+            logging.info(
+                f"Reusing {len(reused_shapes)} of {len(shape_patterns)} shapes from the previous build."
+            )
+
+        # Plan every shape first so that all the routing can run concurrently
+        shape_segments: dict[str, list[tuple[Coordinates, bool]]] = {
+            shape_id: plan_shape_segments(
+                [stop_locations.point(stop_id) for stop_id in stop_seq],
+                [stop_locations.is_in_region(stop_id) for stop_id in stop_seq],
+                pairwise=build.options.routing_mode == "segment",
+            )
+            for shape_id, stop_seq in sorted(shape_patterns.items())
+            if shape_id not in reused_shapes
+        }
+
+        routes = osrm.route_many(
+            [
+                coordinates
+                for segments in shape_segments.values()
+                for coordinates, routed in segments
+                if routed
+            ],
+            desc=f"Generating shapes ({build.feed})",
+            show_progress=build.options.show_progress,
+        )
+
+        with (
+            build.output.open_table("shapes.txt") as shapes_file,
+            ShapesWriter(shapes_file) as shapes_writer,
+        ):
+            for shape_id in sorted(shape_patterns):
+                if shape_id in reused_shapes:
+                    final_shape_points, shape_distances = reused_shapes[shape_id]
+                    if snapshot is not None:
+                        snapshot.complete_shapes.add(shape_id)
+                else:
+                    segments = shape_segments[shape_id]
+                    final_shape_points = np.array(
+                        stitch_segments(
+                            # Fallback to straight lines for segments OSRM could not route
+                            (routed and routes.get(coordinates)) or [list(point) for point in coordinates]
+                            for coordinates, routed in segments
+                        ),
+                        dtype=np.float64,
+                    )
+                    final_shape_points = simplify_shape(final_shape_points, build.options.shape_tolerance)
+                    shape_distances = cumulative_distances(final_shape_points)
+
+                    # Shapes with straight-line fallbacks are routed again next time
+                    if snapshot is not None and all(
+                        routes.get(coordinates) for coordinates, routed in segments if routed
+                    ):
+                        snapshot.complete_shapes.add(shape_id)
+
+                stop_points = np.array(
+                    [stop_locations.point(stop_id) for stop_id in shape_patterns[shape_id]],
+                    dtype=np.float64,
+                )
+                build.stop_distances_by_shape[shape_id] = np.round(
+                    project_onto_shape(final_shape_points, shape_distances, stop_points), 1
+                ).tolist()
+
+                shapes_writer.write_shape(shape_id, final_shape_points, shape_distances)
+
+        build.metrics.osrm = osrm.stats(since=osrm_counters)
+
+
+class StopTimesStage(Stage):
+    """
+    Writes stop_times.txt for the written trips, with the distance of each
+    stop along its shape if shapes were generated.
+    """
+
+    name = "stop_times"
+
+    def run(self, build: FeedBuild) -> None:
+        stop_times = build.stop_times
+        stop_times_fieldnames = list(stop_times.fieldnames)
+        if build.stop_distances_by_shape and "shape_dist_traveled" not in stop_times_fieldnames:
+            stop_times_fieldnames.append("shape_dist_traveled")
+
+        distance_col = (
+            stop_times_fieldnames.index("shape_dist_traveled")
+            if "shape_dist_traveled" in stop_times_fieldnames
+            else None
+        )
+
+        rows_written = 0
+        with build.output.open_table("stop_times.txt") as f:
+            writer = csv.writer(f)
+            writer.writerow(stop_times_fieldnames)
+            for trip_id, trip_rows in stop_times.iter_trip_rows(build.written_trip_ids):
+                stop_distances = build.stop_distances_by_shape.get(build.shape_id_by_trip[trip_id])
+                if stop_distances is not None:
+                    # Rows are in stop_sequence order, the same as the stop pattern
+                    for row, distance in zip(trip_rows, stop_distances):
+                        if distance_col < len(row):
+                            row[distance_col] = distance
+                        else:
+                            row.append(distance)
+                elif distance_col is not None:
+                    # Trips without a shape, such as those with a single stop
+                    for row in trip_rows:
+                        if distance_col >= len(row):
+                            row.append("")
+                writer.writerows(trip_rows)
+                rows_written += len(trip_rows)
+        record_rows(written=rows_written)
+
+
+class WriterStage(Stage):
+    """
+    Finishes the output zip, moving it into place, and saves the snapshot of
+    the input for the next incremental build.
+    """
+
+    name = "zip"
+
+    def run(self, build: FeedBuild) -> None:
+        build.commit()
+        logging.info(
+            f"GTFS data from feed {build.feed} has been zipped successfully at {build.output_zip}."
+        )
+        if build.options.snapshot_file is not None and build.snapshot is not None:
+            build.snapshot.save(build.options.snapshot_file)
+
+
+DEFAULT_STAGES: tuple[Stage, ...] = (
+    RegionFilterStage(),
+    ReadStopTimesStage(),
+    TripSelectionStage(),
+    SnapshotStage(),
+    CopyTablesStage(),
+    StopOverridesStage(),
+    RoutesStage(),
+    HeadsignsStage(),
+    FrequenciesStage(),
+    TripsStage(),
+    ShapesStage(),
+    StopTimesStage(),
+    WriterStage(),
+)
+
+
+def build_feed(
+    feed_name: str,
+    source: str | zipfile.ZipFile,
+    options: BuildOptions | None = None,
+    stages: Sequence[Stage] = DEFAULT_STAGES,
+    metrics: BuildMetrics | None = None,
+) -> bool:
+    """
+    Builds the Galicia GTFS of a feed from its original Renfe GTFS, running
+    each stage in order.
+
+    :param feed_name: The feed name, one of FEEDS
+    :param source: The original feed, as the path of a local zip or opened
+        for reading
+    :param options: How to build the feed, BuildOptions() by default
+    :param stages: The stages to run. The output is only written if one of
+        them commits it, as WriterStage does
+    :param metrics: Records the time, rows and memory of each stage
+    :return: False if the feed has no trips in Galicia and nothing was written
+    :rtype: bool
+    """
+
+    if not isinstance(source, zipfile.ZipFile):
+        # Tables are read straight from the zip, without extracting it
+        with zipfile.ZipFile(source, "r") as input_zip:
+            return build_feed(feed_name, input_zip, options, stages, metrics)
+
+    build = FeedBuild(feed_name, source, options or BuildOptions(), metrics or BuildMetrics())
+    current_metrics.set(build.metrics)
+    try:
+        for stage in stages:
+            if not stage.enabled(build):
+                continue
+            build.metrics.begin(stage.name)
+            stage.run(build)
+            if build.empty:
+                return False
+    finally:
+        build.metrics.end()
+        build.close()
+
+    return True
+
+
+def try_export_feed(
+    gtfs_zip_path: str, formats: Iterable[str], metrics: BuildMetrics, force: bool = False
+) -> str | None:
+    """
+    Runs export_feed as the "export" stage of a build, turning a failure into
+    a message so that it does not fail a feed that was already built.
+
+    :return: None if every export succeeded, or "export failed: <error>"
+    :rtype: str | None
+    """
+
+    metrics.begin("export")
+    try:
+        export_feed(gtfs_zip_path, formats, force)
+    except Exception as e:
+        logging.exception(f"Exporting {gtfs_zip_path} failed")
+        return f"export failed: {type(e).__name__}: {e}"
+    return None
+
+
+def process_feed(
+    feed: str, args: Namespace, shapes_source: str | None, build_options: dict
+) -> str:
+    """
+    Downloads a feed, or takes it from --input, and builds it unless it is
+    unchanged since the last build.
+
+    :param feed: The feed name, one of FEEDS
+    :param args: The parsed command line arguments
+    :param shapes_source: Where shape geometries come from: "osrm" (the server,
+        through the route cache), "cache" (the route cache only, OSRM is
+        offline) or None to skip shape generation
+    :param build_options: Everything besides the input feed that changes the
+        output. A build is only skipped if it matches the one in the state file.
+    :return: What happened to the feed: "built", "unchanged" or "empty",
+        followed by ", export failed: <error>" if exporting it failed
+    :rtype: str
+    """
+
+    current_feed.set(feed)
+
+    OUTPUT_GTFS_ZIP = feed_path(feed, ".zip")
+    STATE_FILE = feed_path(feed, ".state.json")
+    SNAPSHOT_FILE = feed_path(feed, ".snapshot.json.gz")
+    METRICS_FILE = feed_path(feed, ".metrics.json")
+    PROFILE_FILE = feed_path(feed, ".prof")
+
+    FEED_URL = f"https://nap.transportes.gob.es/api/Fichero/download/{FEEDS[feed]}"
+
+    # A local zip given with --input is built instead of downloading the feed
+    local_input = (args.input or {}).get(feed)
+
+    previous_state = load_feed_state(STATE_FILE)
+    # A feed with no trips in Galicia has no output, but is not built again either
+    can_reuse_output = (
+        not args.force
+        and (os.path.exists(OUTPUT_GTFS_ZIP) or previous_state.get("empty", False))
+        and previous_state.get("build_options") == build_options
+    )
+
+    metrics = BuildMetrics(profiler=cProfile.Profile() if args.profile else None)
+    started_at = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    result = "failed"
+    export_error = None
+
+    if local_input is None:
+        INPUT_GTFS_FD, INPUT_GTFS_ZIP = tempfile.mkstemp(suffix=".zip", prefix=f"renfe_galicia_in_{feed}_")
+        os.close(INPUT_GTFS_FD)
+    else:
+        INPUT_GTFS_ZIP = local_input
+    try:
+        if local_input is None:
+            metrics.begin("download")
+            logging.info(f"Downloading GTFS feed '{feed}'...")
+            feed_state = download_feed(
+                FEED_URL,
+                args.nap_apikey,
+                INPUT_GTFS_ZIP,
+                previous_state if can_reuse_output else {},
+            )
+        else:
+            logging.info(f"Building GTFS feed '{feed}' from {local_input}...")
+            with open(local_input, "rb") as f:
+                feed_state = {"sha256": hashlib.file_digest(f, "sha256").hexdigest()}
+
+        if can_reuse_output and (
+            feed_state is None or feed_state["sha256"] == previous_state.get("sha256")
+        ):
+            # The same content may come back with new validators, which are
+            # kept so that the next download can be answered with 304
+            if feed_state is not None:
+                updated_state = {**previous_state, **feed_state}
+                if updated_state != previous_state:
+                    save_feed_state(STATE_FILE, updated_state)
+            if previous_state.get("empty", False):
+                logging.info(f"Feed '{feed}' has not changed since the last build and has no trips in Galicia.")
+                result = "empty"
+                return result
+            logging.info(f"Feed '{feed}' has not changed since the last build, keeping {OUTPUT_GTFS_ZIP}.")
+            result = "unchanged"
+            if args.export:
+                export_error = try_export_feed(OUTPUT_GTFS_ZIP, args.export, metrics)
+            return f"{result}, {export_error}" if export_error else result
+        assert feed_state is not None
+
+        osrm = None
+        if shapes_source is not None:
+            route_cache = None
+            if not args.no_route_cache:
+                route_cache = RouteCache(
+                    args.route_cache,
+                    f"{args.osrm_profile}:{args.osrm_data_version}",
+                    args.route_cache_size * 1024 * 1024,
+                )
+            osrm = OSRMClient(
+                args.osrm_url,
+                concurrency=args.osrm_concurrency,
+                profile=args.osrm_profile,
+                cache=route_cache,
+                offline=shapes_source == "cache",
+            )
+
+        if not args.incremental and os.path.exists(SNAPSHOT_FILE):
+            # It would no longer describe the output this build replaces
+            os.remove(SNAPSHOT_FILE)
+
+        options = BuildOptions(
+            output_zip=OUTPUT_GTFS_ZIP,
+            osrm=osrm,
+            compression=COMPRESSION_METHODS[args.compression],
+            compresslevel=args.compression_level,
+            routing_mode=args.routing_mode,
+            shape_tolerance=args.shape_tolerance,
+            snapshot_file=SNAPSHOT_FILE if args.incremental else None,
+            previous_snapshot_file=(
+                SNAPSHOT_FILE if args.incremental and can_reuse_output else None
+            ),
+            show_progress=args.jobs == 1,
+            frequencies=args.frequencies,
+            low_memory=args.low_memory * 1024 * 1024 if args.low_memory else None,
+        )
+        try:
+            built = build_feed(feed, INPUT_GTFS_ZIP, options, metrics=metrics)
+        finally:
+            if osrm is not None:
+                osrm.close()
+        feed_state["build_options"] = build_options
+        feed_state["empty"] = not built
+        save_feed_state(STATE_FILE, feed_state)
+        if not built:
+            result = "empty"
+            return result
+
+        result = "built"
+
+        # The feed is already built, so a failed export is reported on its own
+        if args.export:
+            export_error = try_export_feed(OUTPUT_GTFS_ZIP, args.export, metrics, force=True)
+        return f"{result}, {export_error}" if export_error else result
+    finally:
+        if local_input is None:
+            os.remove(INPUT_GTFS_ZIP)
+
+        metrics.end()
+        with open(METRICS_FILE, "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "feed": feed,
+                    "started_at": started_at,
+                    "result": result,
+                    "export_error": export_error,
+                    **metrics.to_dict(),
+                },
+                f,
+                indent=2,
+            )
+        if metrics.profiler is not None:
+            metrics.profiler.dump_stats(PROFILE_FILE)
+            logging.info(f"Profile of the slowest stages saved to {PROFILE_FILE}.")
+
+
+def run_feed(
+    feed: str, args: Namespace, shapes_source: str | None, build_options: dict
+) -> tuple[str, str]:
+    """
+    Runs process_feed, turning any failure into a result so that one broken
+    feed does not stop the others.
+
+    :return: The feed name and its outcome, or "failed: <error>"
+    :rtype: tuple[str, str]
+    """
+
+    try:
+        return feed, process_feed(feed, args, shapes_source, build_options)
+    except Exception as e:
+        logging.exception(f"Building feed '{feed}' failed")
+        return feed, f"failed: {type(e).__name__}: {e}"
+
+
+def build_feeds(args: Namespace) -> dict[str, str]:
+    """
+    Builds every feed, in parallel if asked to, and logs a summary.
+
+    :param args: The parsed command line arguments
+    :return: The outcome of each feed, as returned by run_feed
+    :rtype: dict[str, str]
+    """
+
+    import requests
+
+    try:
+        osrm_check = requests.head(args.osrm_url, timeout=5)
+        shapes_source = "osrm" if osrm_check.status_code < 500 else None
+    except requests.RequestException:
+        shapes_source = None
+
+    if shapes_source is None:
+        if not args.no_route_cache and os.path.exists(args.route_cache):
+            shapes_source = "cache"
+            logging.warning("OSRM server is not reachable. Shapes will be generated from the route cache only.")
+        else:
+            logging.warning("OSRM server is not reachable. Shape generation will be skipped.")
+
+    # Anything besides the input feed that changes the output. A build is only
+    # skipped if this matches the one recorded in the feed's state file.
+    with open(STOP_OVERRIDES_FILE, "rb") as f:
+        overrides_hash = hashlib.sha256(f.read()).hexdigest()
+    with open(REGION_FILE, "rb") as f:
+        region_hash = hashlib.sha256(f.read()).hexdigest()
+    build_options = {
+        "stop_overrides": overrides_hash,
+        "region": region_hash,
+        "shapes": shapes_source,
+        "osrm_url": args.osrm_url,
+        "osrm_profile": args.osrm_profile,
+        "osrm_data_version": args.osrm_data_version,
+        "routing_mode": args.routing_mode,
+        "shape_tolerance": args.shape_tolerance,
+        "frequencies": args.frequencies,
+        "compression": args.compression,
+        "compression_level": args.compression_level,
+    }
+
+    # Only the feeds given with --input are built from local zips
+    feeds = list(args.input) if args.input else list(FEEDS)
+
+    results: dict[str, str] = {}
+    if args.jobs > 1:
+        # Forking would copy the threads of --serve and its listening socket
+        # into the workers, so they are started fresh instead
+        with ProcessPoolExecutor(
+            max_workers=min(args.jobs, len(feeds)),
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=setup_logging,
+            initargs=(args.debug,),
+        ) as executor:
+            futures = {
+                feed: executor.submit(run_feed, feed, args, shapes_source, build_options)
+                for feed in feeds
+            }
+            for feed, future in futures.items():
+                # run_feed catches errors in the build itself, but a worker
+                # dying takes the whole pool down with it
+                try:
+                    _, result = future.result()
+                except Exception as e:
+                    logging.error(f"Building feed '{feed}' failed: {type(e).__name__}: {e}")
+                    result = f"failed: {type(e).__name__}: {e}"
+                results[feed] = result
+    else:
+        for feed in feeds:
+            feed, result = run_feed(feed, args, shapes_source, build_options)
+            results[feed] = result
+
+    current_feed.set("-")
+    logging.info("Build summary:")
+    for feed, result in results.items():
+        if "failed" in result:
+            logging.error(f"  {feed}: {result}")
+        else:
+            logging.info(f"  {feed}: {result}")
+
+    return results
+
+
+@dataclass(frozen=True)
+class ServedFile:
+    """
+    A built feed held in memory, as it was when it was loaded. Requests keep
+    the object they started with, so a reload never changes a response
+    halfway through.
+    """
+
+    data: bytes
+    etag: str
+    last_modified: float
+    stat_key: tuple[int, int]
+
+
+class FeedStore:
+    """
+    The latest build of every feed, loaded from the output zips.
+
+    Builds replace the zips atomically, and reload() swaps in the new
+    content of those that changed. Swapping is a single assignment, so
+    requests being served meanwhile are not affected.
+    """
+
+    def __init__(self, paths: dict[str, str]):
+        """
+        :param paths: The URL path each zip is served at, and its file
+        """
+
+        self.paths = paths
+        self.files: dict[str, ServedFile] = {}
+        self._lock = threading.Lock()
+
+    def reload(self) -> None:
+        with self._lock:
+            files = dict(self.files)
+            for url_path, file_path in self.paths.items():
+                try:
+                    stat = os.stat(file_path)
+                except FileNotFoundError:
+                    files.pop(url_path, None)
+                    continue
+
+                stat_key = (stat.st_mtime_ns, stat.st_size)
+                if url_path in files and files[url_path].stat_key == stat_key:
+                    continue
+
+                with open(file_path, "rb") as f:
+                    data = f.read()
+                files[url_path] = ServedFile(
+                    data=data,
+                    etag=f'"{hashlib.sha256(data).hexdigest()[:32]}"',
+                    last_modified=stat.st_mtime,
+                    stat_key=stat_key,
+                )
+                logging.info(f"Serving {url_path} ({len(data) / 1024:.0f} KiB, ETag {files[url_path].etag}).")
+
+            self.files = files
+
+    def get(self, url_path: str) -> ServedFile | None:
+        return self.files.get(url_path)
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """
+    Parses a single-range Range header, as in "bytes=0-1023", "bytes=1024-"
+    or "bytes=-1024".
+
+    :return: The first and last byte of the range, clamped to the content,
+        (size, size - 1) if it is unsatisfiable, or None if the header is not
+        a single byte range and the whole content should be sent
+    :rtype: tuple[int, int] | None
+    """
+
+    unit, _, ranges = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+
+    first, _, last = ranges.strip().partition("-")
+    try:
+        if not first:
+            suffix = int(last)
+            if suffix == 0:
+                return size, size - 1
+            return max(size - suffix, 0), size - 1
+        start = int(first)
+        end = int(last) if last else max(start, size - 1)
+    except ValueError:
+        return None
+
+    if start > end:
+        return None
+    if start >= size:
+        return size, size - 1
+    return start, min(end, size - 1)
+
+
+class FeedRequestHandler(BaseHTTPRequestHandler):
+    """
+    Serves the files of a FeedStore with strong ETags, conditional requests
+    (304 Not Modified) and byte ranges.
+    """
+
+    store: FeedStore
+    protocol_version = "HTTP/1.1"
+    server_version = "gtfs-renfe-galicia"
+
+    def log_message(self, format, *args) -> None:
+        logging.debug(f"{self.address_string()} {format % args}")
+
+    def _etag_matches(self, header: str, etag: str) -> bool:
+        return header.strip() == "*" or etag in (tag.strip() for tag in header.split(","))
+
+    def _not_modified_since(self, header: str, last_modified: float) -> bool:
+        try:
+            since = email.utils.parsedate_to_datetime(header).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(last_modified) <= since
+
+    def do_HEAD(self) -> None:
+        self._serve(send_body=False)
+
+    def do_GET(self) -> None:
+        self._serve(send_body=True)
+
+    def _serve(self, send_body: bool) -> None:
+        served = self.store.get(self.path.split("?", 1)[0])
+        if served is None:
+            self.send_error(404)
+            return
+
+        if_none_match = self.headers.get("If-None-Match")
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if (
+            (if_none_match is not None and self._etag_matches(if_none_match, served.etag))
+            or (if_none_match is None and if_modified_since is not None
+                and self._not_modified_since(if_modified_since, served.last_modified))
+        ):
+            self.send_response(304)
+            self._send_validators(served)
+            self.end_headers()
+            return
+
+        size = len(served.data)
+        start, end = 0, size - 1
+        status = 200
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        if range_header is not None and (if_range is None or if_range.strip() == served.etag):
+            requested = parse_range(range_header, size)
+            if requested is not None:
+                start, end = requested
+                status = 206
+                if start >= size:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{size}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+
+        self.send_response(status)
+        self._send_validators(served)
+        self.send_header("Content-Type", "application/zip")
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+
+        if send_body:
+            self.wfile.write(memoryview(served.data)[start:end + 1])
+
+    def _send_validators(self, served: ServedFile) -> None:
+        self.send_header("ETag", served.etag)
+        self.send_header("Last-Modified", email.utils.formatdate(served.last_modified, usegmt=True))
+        # Clients may keep a copy but have to revalidate it, which is cheap
+        self.send_header("Cache-Control", "no-cache")
+
+
+def start_server(address: str, store: FeedStore) -> ThreadingHTTPServer:
+    """
+    Starts serving a FeedStore in a background thread.
+
+    :param address: "host:port", "[ipv6 host]:port", or just the port to
+        listen on every IPv4 interface
+    :return: The running server, stopped with shutdown()
+    :rtype: ThreadingHTTPServer
+    """
+
+    host, _, port = address.rpartition(":")
+    server_class = ThreadingHTTPServer
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+        server_class = type("ThreadingHTTPServerV6", (ThreadingHTTPServer,), {"address_family": socket.AF_INET6})
+    handler = type("BoundFeedRequestHandler", (FeedRequestHandler,), {"store": store})
+    server = server_class((host, int(port)), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="feed-server", daemon=True).start()
+
+    url_host = f"[{host}]" if server_class is not ThreadingHTTPServer else host or "0.0.0.0"
+    logging.info(f"Serving feeds on http://{url_host}:{server.server_address[1]}/")
+    return server
+
+
+def rebuild_served_feeds(args: Namespace, store: FeedStore) -> None:
+    """
+    Builds the feeds and reloads them into the store. If that fails the
+    error is logged and the zips loaded before keep being served.
+    """
+
+    try:
+        build_feeds(args)
+        store.reload()
+    except Exception:
+        logging.exception("Rebuilding the served feeds failed, serving the previous build")
+
+
+def serve_feeds(args: Namespace) -> None:
+    """
+    Serves the built feeds until interrupted, building them first and then
+    every `args.rebuild_interval` minutes if set. The zips already on disk
+    are served while the first build runs.
+    """
+
+    store = FeedStore({
+        f"/gtfs_renfe_galicia_{feed}.zip": feed_path(feed, ".zip")
+        for feed in FEEDS
+    })
+    store.reload()
+    server = start_server(args.serve, store)
+    try:
+        rebuild_served_feeds(args, store)
+        while args.rebuild_interval is not None:
+            logging.info(f"Next build in {args.rebuild_interval} minutes.")
+            time.sleep(args.rebuild_interval * 60)
+            rebuild_served_feeds(args, store)
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def parse_feed_input(value: str) -> tuple[str, str]:
+    """
+    Parses an --input argument, "FEED=PATH".
+
+    :return: The feed name and the path of its local zip
+    :rtype: tuple[str, str]
+    """
+
+    feed, _, path = value.partition("=")
+    if feed not in FEEDS or not path:
+        raise ArgumentTypeError(f"expected FEED=PATH with FEED one of {', '.join(FEEDS)}")
+    if not os.path.isfile(path):
+        raise ArgumentTypeError(f"{path} does not exist")
+    return feed, os.path.abspath(path)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Extract GTFS data for Galicia from Renfe GTFS feed."
+    )
+    parser.add_argument(
+        "nap_apikey",
+        type=str,
+        nargs="?",
+        help="NAP API Key (https://nap.transportes.gob.es/), not needed with --input"
+    )
+    parser.add_argument(
+        "--input",
+        type=parse_feed_input,
+        action="append",
+        metavar="FEED=PATH",
+        help="Build FEED from a local copy of its original GTFS zip instead of downloading it. Only the feeds given are built. Can be repeated",
+    )
+    parser.add_argument(
+        "--osrm-url",
+        type=str,
+        help="OSRM server URL",
+        default="http://localhost:5050",
+        required=False,
+    )
+    parser.add_argument(
+        "--osrm-concurrency",
+        type=int,
+        help="Maximum number of concurrent requests to the OSRM server",
+        default=8,
+    )
+    parser.add_argument(
+        "--osrm-profile",
+        type=str,
+        help="OSRM routing profile used in request URLs",
+        default="driving",
+    )
+    parser.add_argument(
+        "--osrm-data-version",
+        type=str,
+        help="Identifier of the OSRM dataset, part of the route cache keys. Change it after rebuilding the OSRM container to stop reusing old routes",
+        default="",
+    )
+    parser.add_argument(
+        "--routing-mode",
+        choices=["segment", "sequence"],
+        help="Route each distinct stop-to-stop segment once and stitch shapes from them (segment), or route each run of stops in Galicia in a single request (sequence)",
+        default="segment",
+    )
+    parser.add_argument(
+        "--shape-tolerance",
+        type=float,
+        help="Tolerance in metres for simplifying shapes (Douglas-Peucker), 0 to keep every point",
+        default=5.0,
+    )
+    parser.add_argument(
+        "--route-cache",
+        type=str,
+        help="Path of the persistent OSRM route cache",
+        default=os.path.join(os.path.dirname(__file__), "route_cache.sqlite"),
+    )
+    parser.add_argument(
+        "--route-cache-size",
+        type=int,
+        help="Maximum size of the route cache in MiB, least recently used routes are evicted first",
+        default=256,
+    )
+    parser.add_argument(
+        "--no-route-cache",
+        help="Do not read or write the route cache",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--clear-route-cache",
+        help="Empty the route cache before building",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--compression",
+        choices=COMPRESSION_METHODS.keys(),
+        help="Compression method of the output zips. Most GTFS consumers only support deflated and stored",
+        default="deflated",
+    )
+    parser.add_argument(
+        "--compression-level",
+        type=int,
+        help="Compression level of the output zips (0-9 for deflated and bzip2), defaults to the method's default",
+        default=None,
+    )
+    parser.add_argument(
+        "--debug",
+        help="Enable debug logging",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--force",
+        help="Rebuild every feed even if its input has not changed since the last build",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--incremental",
+        help="Only route the shapes of stop patterns that are new or whose stops moved since the previous build, copying the rest from the previous output",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--profile",
+        help="Run the slowest stages of each build under cProfile and save the stats to gtfs_renfe_galicia_{feed}.prof",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--frequencies",
+        help="Write trips that repeat the same stop times at a constant headway as a single trip plus frequencies.txt entries",
+        action="store_true"
+    )
+    parser.add_argument(
+        "--export",
+        choices=list(EXPORTERS),
+        action="append",
+        help="Also export each feed's tables, with typed columns and times in seconds, to gtfs_renfe_galicia_{feed}.sqlite (indexed) or a directory of Parquet files gtfs_renfe_galicia_{feed}.parquet (requires pyarrow). Can be repeated",
+    )
+    parser.add_argument(
+        "--low-memory",
+        type=int,
+        metavar="MIB",
+        help="Sort stop_times.txt on disk using about this many MiB of memory instead of loading it whole",
+    )
+    parser.add_argument(
+        "--serve",
+        type=str,
+        metavar="[HOST:]PORT",
+        help="After building, keep serving the feeds over HTTP with ETags, conditional requests and byte ranges. IPv6 hosts go in brackets, as in [::1]:8080",
+    )
+    parser.add_argument(
+        "--rebuild-interval",
+        type=float,
+        metavar="MINUTES",
+        help="With --serve, build the feeds again every this many minutes and serve the new ones as soon as they are ready",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        help="Number of feeds to build in parallel, each in its own process",
+        default=1,
+    )
+
+    args = parser.parse_args()
+    args.input = dict(args.input) if args.input else None
+    if args.rebuild_interval is not None and args.serve is None:
+        parser.error("--rebuild-interval requires --serve")
+    if args.export and "parquet" in args.export and importlib.util.find_spec("pyarrow") is None:
+        parser.error("--export parquet requires pyarrow, install it with `pip install pyarrow`")
+    if args.nap_apikey is None and args.input is None:
+        parser.error("the NAP API key is required unless the feeds are given with --input")
+
+    setup_logging(args.debug)
+
+    if args.clear_route_cache and os.path.exists(args.route_cache):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(args.route_cache + suffix):
+                os.remove(args.route_cache + suffix)
+        logging.info(f"Cleared route cache {args.route_cache}.")
+
+    if args.serve is not None:
+        serve_feeds(args)
+    else:
+        results = build_feeds(args)
+        if any("failed" in result for result in results.values()):
+            sys.exit(1)
@@ -0,0 +1,123 @@
+import io
+import zipfile
+
+import pytest
+
+import build_static_feed as builder
+
+
+# Minutes from the start of the trip at which it reaches each stop
+PATTERN = [("31412", 0), ("31305", 12), ("31304", 25)]
+
+
+def hhmm(value: str) -> int:
+    return builder.parse_gtfs_time(f"{value}:00")
+
+
+def make_trip(trip_id: str, service_id: str = "S1", headsign: str = "Vigo") -> dict:
+    return {
+        "route_id": "R1",
+        "service_id": service_id,
+        "trip_id": trip_id,
+        "trip_headsign": headsign,
+    }
+
+
+def make_store(starts: dict[str, int]) -> builder.StopTimesStore:
+    """
+    A store with a trip following PATTERN from each of the given start times.
+    """
+
+    lines = ["trip_id,arrival_time,departure_time,stop_id,stop_sequence"]
+    for trip_id, start in starts.items():
+        for sequence, (stop_id, minutes) in enumerate(PATTERN, start=1):
+            time = builder.format_gtfs_time(start + minutes * 60)
+            lines.append(f"{trip_id},{time},{time},{stop_id},{sequence}")
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as gtfs_zip:
+        gtfs_zip.writestr("stop_times.txt", "\n".join(lines) + "\n")
+    with zipfile.ZipFile(buffer, "r") as gtfs_zip:
+        return builder.build_stop_times_store(gtfs_zip)
+
+
+def expand(trips: list[dict], frequencies: list[dict], starts: dict[str, int]) -> list[int]:
+    """
+    The start times of every trip that runs once the frequencies are applied.
+    """
+
+    expanded: list[int] = []
+    templates = {row["trip_id"] for row in frequencies}
+    for trip in trips:
+        if trip["trip_id"] not in templates:
+            expanded.append(starts[trip["trip_id"]])
+    for row in frequencies:
+        start = builder.parse_gtfs_time(row["start_time"])
+        end = builder.parse_gtfs_time(row["end_time"])
+        expanded.extend(range(start, end, row["headway_secs"]))
+    return sorted(expanded)
+
+
+def test_compacted_trips_expand_to_original_starts():
+    starts = {
+        **{f"T{k}": hhmm("06:00") + k * 1800 for k in range(6)},
+        "EARLY": hhmm("05:10"),
+        "LATE": hhmm("22:45"),
+    }
+    trips = [make_trip(trip_id) for trip_id in starts]
+
+    kept, frequencies = builder.compact_frequencies(trips, make_store(starts))
+
+    assert frequencies == [{
+        "trip_id": "T0",
+        "start_time": "06:00:00",
+        "end_time": "09:00:00",
+        "headway_secs": 1800,
+        "exact_times": 1,
+    }]
+    assert [trip["trip_id"] for trip in kept] == ["T0", "EARLY", "LATE"]
+    assert expand(kept, frequencies, starts) == sorted(starts.values())
+
+
+@pytest.mark.parametrize("count, min_trips", [(2, 3), (3, 4)])
+def test_runs_shorter_than_min_trips_are_kept(count, min_trips):
+    starts = {f"T{k}": hhmm("06:00") + k * 1800 for k in range(count)}
+    trips = [make_trip(trip_id) for trip_id in starts]
+
+    kept, frequencies = builder.compact_frequencies(trips, make_store(starts), min_trips=min_trips)
+
+    assert frequencies == []
+    assert kept == trips
+
+
+def test_runs_of_a_group_share_template_without_overlapping():
+    starts = {
+        **{f"A{k}": hhmm("06:00") + k * 1800 for k in range(4)},
+        **{f"B{k}": hhmm("10:00") + k * 3600 for k in range(4)},
+    }
+    trips = [make_trip(trip_id) for trip_id in starts]
+
+    kept, frequencies = builder.compact_frequencies(trips, make_store(starts))
+
+    assert [trip["trip_id"] for trip in kept] == ["A0"]
+    assert [(row["trip_id"], row["start_time"], row["end_time"], row["headway_secs"]) for row in frequencies] == [
+        ("A0", "06:00:00", "08:00:00", 1800),
+        ("A0", "10:00:00", "14:00:00", 3600),
+    ]
+    assert expand(kept, frequencies, starts) == sorted(starts.values())
+
+
+@pytest.mark.parametrize("column, values", [("service_id", ("S1", "S2")), ("headsign", ("Vigo", "Ourense"))])
+def test_groups_differing_in_trip_columns_are_not_merged(column, values):
+    # Together the trips run every 30 minutes, but each variant only every hour
+    starts = {f"T{k}": hhmm("06:00") + k * 1800 for k in range(6)}
+    trips = [make_trip(trip_id, **{column: values[k % 2]}) for k, trip_id in enumerate(starts)]
+
+    kept, frequencies = builder.compact_frequencies(trips, make_store(starts))
+
+    assert [(row["trip_id"], row["start_time"], row["headway_secs"]) for row in frequencies] == [
+        ("T0", "06:00:00", 3600),
+        ("T1", "06:30:00", 3600),
+    ]
+    assert [trip["trip_id"] for trip in kept] == ["T0", "T1"]
+    assert expand(kept, frequencies, starts) == sorted(starts.values())
@@ -0,0 +1,143 @@
+import random
+import threading
+import time
+import zipfile
+
+import numpy as np
+
+import build_static_feed as builder
+from benchmark import StubOSRMHandler, stub_osrm_server
+
+
+class FlakyOSRMHandler(StubOSRMHandler):
+    """
+    Fails the first request for every route with 503, and answers the rest
+    after a random delay so that concurrent requests finish out of order.
+    """
+
+    seen: set[str] = set()
+    lock = threading.Lock()
+
+    def do_GET(self) -> None:
+        with self.lock:
+            first_attempt = self.path not in self.seen
+            self.seen.add(self.path)
+        if first_attempt:
+            self._send(503)
+            return
+
+        time.sleep(random.uniform(0, 0.02))
+        super().do_GET()
+
+
+class NoRouteOSRMHandler(StubOSRMHandler):
+    def do_GET(self) -> None:
+        self._send(400, b'{"code": "NoRoute"}')
+
+
+def coordinate_lists(count: int) -> list[builder.Coordinates]:
+    return [
+        ((-8.5 + k * 0.01, 42.8), (-8.4 + k * 0.01, 42.9), (-8.3, 43.0 + k * 0.01))
+        for k in range(count)
+    ]
+
+
+def test_route_many_retries_failed_requests():
+    FlakyOSRMHandler.seen.clear()
+    with stub_osrm_server(FlakyOSRMHandler) as url:
+        osrm = builder.OSRMClient(url, concurrency=4, backoff=0.01)
+        try:
+            routes = osrm.route_many(coordinate_lists(10), show_progress=False)
+        finally:
+            osrm.close()
+
+    assert all(geometry is not None for geometry in routes.values())
+    assert osrm.requests == 10
+    assert osrm.failures == 0
+
+
+def test_route_many_keeps_input_order():
+    coordinates = coordinate_lists(30)
+    FlakyOSRMHandler.seen.clear()
+    with stub_osrm_server(FlakyOSRMHandler) as url:
+        osrm = builder.OSRMClient(url, concurrency=8, backoff=0.01)
+        try:
+            routes = osrm.route_many(coordinates + coordinates[:5], show_progress=False)
+        finally:
+            osrm.close()
+
+    # Duplicates are routed once, and each result belongs to its own input
+    assert list(routes) == coordinates
+    for points, geometry in routes.items():
+        assert geometry[0] == list(points[0])
+        assert geometry[-1] == list(points[-1])
+
+
+STOPS = [
+    ("90001", "A Coruña", 43.353, -8.409),
+    ("90002", "Santiago de Compostela", 42.870, -8.545),
+    ("90003", "Ourense", 42.351, -7.872),
+]
+
+
+def write_feed(path) -> None:
+    """
+    Writes a feed with a single trip between STOPS.
+    """
+
+    with zipfile.ZipFile(path, "w") as z:
+        z.writestr("agency.txt", "agency_id,agency_name,agency_url,agency_timezone\n1071,Renfe,https://renfe.com,Europe/Madrid\n")
+        z.writestr("stops.txt", "stop_id,stop_name,stop_lat,stop_lon\n" + "".join(f"{s[0]},{s[1]},{s[2]},{s[3]}\n" for s in STOPS))
+        z.writestr("routes.txt", "route_id,agency_id,route_short_name,route_long_name,route_type\nR1,1071,MD,Coruña - Ourense,2\n")
+        z.writestr("trips.txt", "route_id,service_id,trip_id\nR1,S1,T1\n")
+        z.writestr(
+            "stop_times.txt",
+            "trip_id,arrival_time,departure_time,stop_id,stop_sequence\n"
+            "T1,08:00:00,08:00:00,90001,1\nT1,08:30:00,08:31:00,90002,2\nT1,09:30:00,09:30:00,90003,3\n",
+        )
+
+
+def test_unroutable_shapes_fall_back_to_straight_lines(tmp_path):
+    input_zip = tmp_path / "input.zip"
+    write_feed(input_zip)
+
+    output_zip = tmp_path / "output.zip"
+    with stub_osrm_server(NoRouteOSRMHandler) as url:
+        osrm = builder.OSRMClient(url, retries=0)
+        try:
+            options = builder.BuildOptions(output_zip=str(output_zip), osrm=osrm, show_progress=False)
+            assert builder.build_feed("general", str(input_zip), options)
+        finally:
+            osrm.close()
+
+    assert osrm.failures == osrm.requests == 2
+    shapes = builder.read_shapes(str(output_zip), {builder.shape_id_for_pattern([s[0] for s in STOPS])})
+    (points, distances), = shapes.values()
+    np.testing.assert_allclose(points, [(lon, lat) for _, _, lat, lon in STOPS])
+    assert distances[0] == 0 and np.all(np.diff(distances) > 0)
+
+
+def test_metrics_count_each_build_of_a_reused_client(tmp_path):
+    input_zip = tmp_path / "input.zip"
+    write_feed(input_zip)
+
+    cache = builder.RouteCache(str(tmp_path / "route_cache.sqlite"), "test", 1024 * 1024)
+    with stub_osrm_server() as url:
+        osrm = builder.OSRMClient(url, cache=cache)
+        try:
+            builds = []
+            for feed in ("general", "cercanias"):
+                metrics = builder.BuildMetrics()
+                options = builder.BuildOptions(output_zip=str(tmp_path / f"{feed}.zip"), osrm=osrm, show_progress=False)
+                assert builder.build_feed(feed, str(input_zip), options, metrics=metrics)
+                builds.append(metrics.osrm)
+        finally:
+            osrm.close()
+
+    first, second = builds
+    assert first["requests"] == first["cache_misses"] == 2
+    assert first["cache_hits"] == 0
+    assert second["requests"] == second["cache_misses"] == 0
+    assert second["cache_hits"] == 2
+    assert second["cache_hit_rate"] == 1
+    assert "latency_ms" in first and "latency_ms" not in second
@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+
+import build_static_feed as builder
+
+
+@pytest.fixture(scope="module")
+def region():
+    return builder.Region.from_geojson(builder.REGION_FILE)
+
+
+# Stations on either side of the border of Galicia, as (lat, lon)
+@pytest.mark.parametrize("station, lat, lon, inside", [
+    ("Tui", 42.0467, -8.6437, True),
+    ("Valença", 42.0266, -8.6440, False),
+    ("Ribadeo", 43.5357, -7.0420, True),
+    ("Castropol", 43.5280, -7.0300, False),
+    ("Quereño", 42.4340, -6.8810, True),
+    ("Puente de Domingo Flórez", 42.4116, -6.8208, False),
+])
+def test_border_stations(region, station, lat, lon, inside):
+    assert region.contains(np.array([lon]), np.array([lat])).tolist() == [inside]
+
+
+def test_grid_matches_even_odd_test(region):
+    random = np.random.default_rng(42)
+    margin = 0.5
+    lons = random.uniform(region.west - margin, region.east + margin, 20000)
+    lats = random.uniform(region.south - margin, region.north + margin, 20000)
+
+    inside = region.contains(lons, lats)
+
+    assert inside.any() and not inside.all()
+    assert np.array_equal(inside, region._crosses_odd(lons, lats))
+
+
+def test_holes_and_small_grids_match_even_odd_test():
+    # A square with a square hole, indexed with cells larger than the hole
+    outer = [[0, 0], [10, 0], [10, 10], [0, 10]]
+    hole = [[4, 4], [6, 4], [6, 6], [4, 6]]
+    region = builder.Region([outer, hole], grid_size=3)
+
+    assert region.contains(np.array([2.0, 5.0, 12.0]), np.array([2.0, 5.0, 5.0])).tolist() == [True, False, False]
+
+    random = np.random.default_rng(7)
+    lons = random.uniform(-1, 11, 5000)
+    lats = random.uniform(-1, 11, 5000)
+    assert np.array_equal(region.contains(lons, lats), region._crosses_odd(lons, lats))
@@ -0,0 +1,136 @@
+import email.utils
+import http.client
+import os
+
+import pytest
+
+import build_static_feed as builder
+
+
+URL_PATH = "/gtfs_renfe_galicia_general.zip"
+CONTENT = bytes(range(256)) * 40
+
+
+@pytest.fixture
+def feed_file(tmp_path):
+    path = tmp_path / "gtfs_renfe_galicia_general.zip"
+    path.write_bytes(CONTENT)
+    return path
+
+
+@pytest.fixture
+def store(feed_file):
+    store = builder.FeedStore({URL_PATH: str(feed_file)})
+    store.reload()
+    return store
+
+
+@pytest.fixture
+def server(store):
+    server = builder.start_server("127.0.0.1:0", store)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def get(server):
+    def get(headers: dict[str, str] | None = None, path: str = URL_PATH) -> tuple[int, dict[str, str], bytes]:
+        connection = http.client.HTTPConnection("127.0.0.1", server.server_address[1], timeout=5)
+        try:
+            connection.request("GET", path, headers=headers or {})
+            response = connection.getresponse()
+            return response.status, dict(response.getheaders()), response.read()
+        finally:
+            connection.close()
+
+    return get
+
+
+def test_full_response(get):
+    status, headers, body = get()
+
+    assert status == 200
+    assert body == CONTENT
+    assert headers["Content-Length"] == str(len(CONTENT))
+    assert headers["Accept-Ranges"] == "bytes"
+    assert headers["ETag"].startswith('"')
+
+
+def test_unknown_path(get):
+    status, _, _ = get(path="/gtfs_renfe_galicia_otro.zip")
+
+    assert status == 404
+
+
+def test_if_none_match(get):
+    _, headers, _ = get()
+    status, not_modified_headers, body = get({"If-None-Match": headers["ETag"]})
+
+    assert status == 304
+    assert body == b""
+    assert not_modified_headers["ETag"] == headers["ETag"]
+    assert get({"If-None-Match": '"other"'})[0] == 200
+
+
+def test_if_modified_since(get, feed_file):
+    mtime = os.stat(feed_file).st_mtime
+
+    status, _, body = get({"If-Modified-Since": email.utils.formatdate(mtime + 60, usegmt=True)})
+    assert status == 304
+    assert body == b""
+
+    status, _, _ = get({"If-Modified-Since": email.utils.formatdate(mtime - 60, usegmt=True)})
+    assert status == 200
+
+
+@pytest.mark.parametrize("range_header, start, end", [
+    ("bytes=100-199", 100, 199),
+    ("bytes=10000-", 10000, len(CONTENT) - 1),
+    ("bytes=-240", len(CONTENT) - 240, len(CONTENT) - 1),
+    ("bytes=10000-99999", 10000, len(CONTENT) - 1),
+])
+def test_range(get, range_header, start, end):
+    status, headers, body = get({"Range": range_header})
+
+    assert status == 206
+    assert headers["Content-Range"] == f"bytes {start}-{end}/{len(CONTENT)}"
+    assert headers["Content-Length"] == str(end - start + 1)
+    assert body == CONTENT[start:end + 1]
+
+
+def test_range_past_the_end(get):
+    status, headers, body = get({"Range": f"bytes={len(CONTENT)}-"})
+
+    assert status == 416
+    assert headers["Content-Range"] == f"bytes */{len(CONTENT)}"
+    assert body == b""
+
+
+def test_if_range(get):
+    _, headers, _ = get()
+
+    status, _, body = get({"Range": "bytes=0-9", "If-Range": headers["ETag"]})
+    assert status == 206
+    assert body == CONTENT[:10]
+
+    status, _, body = get({"Range": "bytes=0-9", "If-Range": '"other"'})
+    assert status == 200
+    assert body == CONTENT
+
+
+def test_reload_swaps_etag(get, store, feed_file):
+    _, headers, _ = get()
+
+    new_content = CONTENT[::-1] + b"new"
+    feed_file.write_bytes(new_content)
+    stat = os.stat(feed_file)
+    os.utime(feed_file, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1_000_000_000))
+    store.reload()
+
+    status, new_headers, body = get()
+    assert status == 200
+    assert body == new_content
+    assert new_headers["ETag"] != headers["ETag"]
+    assert get({"If-None-Match": headers["ETag"]})[0] == 200
+    assert get({"If-None-Match": new_headers["ETag"]})[0] == 304
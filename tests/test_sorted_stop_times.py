@@ -0,0 +1,50 @@
+import logging
+import re
+import zipfile
+
+import pytest
+
+import benchmark
+import build_static_feed as builder
+
+
+@pytest.fixture(scope="module")
+def input_zip(tmp_path_factory):
+    path = tmp_path_factory.mktemp("input") / "feed.zip"
+    benchmark.generate_feed(str(path), 0.02)
+    return path
+
+
+def build(input_path, output_path, **options) -> dict[str, list[str]]:
+    """
+    Builds the general feed and returns its tables, with their lines sorted
+    since trips are in a different order with low_memory.
+    """
+
+    with zipfile.ZipFile(input_path, "r") as input_zip:
+        assert builder.build_feed(
+            "general",
+            input_zip,
+            builder.BuildOptions(output_zip=str(output_path), show_progress=False, **options),
+        )
+    with zipfile.ZipFile(output_path, "r") as output_zip:
+        return {name: sorted(output_zip.read(name).decode("utf-8").splitlines()) for name in output_zip.namelist()}
+
+
+@pytest.mark.parametrize("frequencies", [False, True], ids=["trips", "frequencies"])
+def test_low_memory_build_matches_in_memory_build(input_zip, tmp_path, monkeypatch, caplog, frequencies):
+    expected = build(input_zip, tmp_path / "memory.zip", frequencies=frequencies)
+
+    # A tiny budget and fan-in force many runs and intermediate merge passes
+    monkeypatch.setattr(builder, "MERGE_FAN_IN", 4)
+    with caplog.at_level(logging.DEBUG):
+        tables = build(input_zip, tmp_path / "low_memory.zip", frequencies=frequencies, low_memory=2000)
+
+    runs = int(re.search(r"stop_times rows in (\d+) runs", caplog.text).group(1))
+    assert runs > builder.MERGE_FAN_IN ** 2
+    assert tables.keys() == expected.keys()
+    for name in expected:
+        assert tables[name] == expected[name], name
+    assert len(expected["stop_times.txt"]) > 1
+    if frequencies:
+        assert len(expected["frequencies.txt"]) > 1
@@ -0,0 +1,49 @@
+import zipfile
+
+import pytest
+
+import build_static_feed as builder
+
+
+TABLES = {
+    "agency.txt": "agency_id,agency_name,agency_url,agency_timezone\n1071,Renfe Viajeros,https://www.renfe.com,Europe/Madrid\n",
+    "calendar.txt": "service_id,monday,tuesday,wednesday,thursday,friday,saturday,sunday,start_date,end_date\n"
+    + "".join(f"S{k},1,1,1,1,1,0,0,20260101,20261231\n" for k in range(100)),
+}
+
+
+@pytest.mark.parametrize("compression", builder.COMPRESSION_METHODS.values(), ids=builder.COMPRESSION_METHODS.keys())
+@pytest.mark.parametrize("source_compression", [zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED], ids=["stored", "deflated"])
+def test_copied_tables_round_trip(tmp_path, compression, source_compression):
+    input_path = tmp_path / "input.zip"
+    with zipfile.ZipFile(input_path, "w", source_compression) as input_zip:
+        for name, content in TABLES.items():
+            input_zip.writestr(name, content)
+
+    output_path = tmp_path / "output.zip"
+    with zipfile.ZipFile(input_path, "r") as input_zip, builder.GTFSZipWriter(str(output_path), compression) as output:
+        for name in TABLES:
+            output.copy_member(input_zip, name)
+        output.write_table("stops.txt", ["stop_id"], [{"stop_id": "1"}])
+
+    with zipfile.ZipFile(output_path, "r") as output_zip:
+        assert output_zip.testzip() is None
+        assert output_zip.read("stops.txt") == b"stop_id\r\n1\r\n"
+        for name, content in TABLES.items():
+            assert output_zip.read(name) == content.encode("utf-8")
+            assert output_zip.getinfo(name).compress_type == compression
+
+
+def test_aborted_output_leaves_previous_zip(tmp_path):
+    output_path = tmp_path / "output.zip"
+    with builder.GTFSZipWriter(str(output_path)) as output:
+        output.write_table("stops.txt", ["stop_id"], [{"stop_id": "1"}])
+
+    with pytest.raises(RuntimeError):
+        with builder.GTFSZipWriter(str(output_path)) as output:
+            output.write_table("stops.txt", ["stop_id"], [{"stop_id": "2"}])
+            raise RuntimeError
+
+    with zipfile.ZipFile(output_path, "r") as output_zip:
+        assert output_zip.read("stops.txt") == b"stop_id\r\n1\r\n"
+    assert [path.name for path in tmp_path.iterdir()] == ["output.zip"]